@@ -1,13 +1,121 @@
 import os
-from flask import Flask, request, abort, jsonify
+import json
+from datetime import datetime, timezone
+from flask import Flask, Response, request, abort, jsonify, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
-from models import setup_db, Movies, Rents
-from auth import requires_auth, AuthError
+from models import setup_db, db, pool_status, replica_set, batches, Movies, Rents, RentalStats, SoldOut
+from auth import requires_auth, AuthError, jwks_cache, token_cache
+from cache import conditional, response_cache
+from catalog import price_catalog
+from instrumentation import init_instrumentation
+from search import search_movies
+from metrics import registry, init_metrics
+from replicas import init_replicas, use_replica
+from idempotency import idempotent, keep_pending
+from exports import export_response
+from serializers import RowEncoder, rows_response, dumps
+from limits import init_limits, limits
+from events import EVENTS_ENABLED, broadcaster, event_stream, init_events
+from writebehind import RENT_WRITE_BEHIND, rent_queue, init_write_behind, QueueFull, RentPending
+from pagination import encode_cursor, decode_cursor, keyset_filter, keyset_order, InvalidCursor
+
+MOVIES_PAGE_SIZE = int(os.environ.get('MOVIES_PAGE_SIZE', 50))
+MOVIES_MAX_PAGE_SIZE = int(os.environ.get('MOVIES_MAX_PAGE_SIZE', 500))
+RENTS_CHUNK_SIZE = int(os.environ.get('RENTS_CHUNK_SIZE', 1000))
+RETRY_AFTER_SECONDS = int(os.environ.get('RETRY_AFTER_SECONDS', 1))
+
+# Orderings allowed on `/movies`, every one of them is backed by an index ending in `id`.
+MOVIE_SORTS = {
+    'id': lambda: [Movies.id],
+    'name': lambda: [Movies.movie_name, Movies.id],
+    'price': lambda: [Movies.price, Movies.id],
+}
+
+# Fields a client can pick with `?fields=`, in the order they are returned by default.
+MOVIE_FIELDS = ['id', 'movie_name', 'price', 'available']
+RENT_FIELDS = ['id', 'movie_id', 'charges', 'rented_at', 'movie']
+
+# The fields named in the comma separated `name` argument, all of `allowed` when it is missing.
+def requested_fields(name, allowed):
+    value = request.args.get(name)
+    if value is None:
+        return list(allowed)
+    fields = [field.strip() for field in value.split(',') if field.strip()]
+    if not fields or any(field not in allowed for field in fields):
+        abort(400)
+    return list(dict.fromkeys(fields))
+
+# Hit and miss counts of the in-process caches, reported as gauges on /metrics.
+def cache_gauges():
+    caches = {
+        'jwks': jwks_cache.stats,
+        'tokens': token_cache.stats,
+        'responses': response_cache.stats,
+        'prices': price_catalog.stats
+    }
+    hits = {(name,): stats['hits'] for name, stats in caches.items()}
+    misses = {(name,): stats['misses'] for name, stats in caches.items()}
+    ratios = {k: hits[k] / (hits[k] + misses[k]) if hits[k] + misses[k] else None for k in hits}
+    return [
+        ('cache_hits', 'Cache hits in this process.', ('cache',), hits),
+        ('cache_misses', 'Cache misses in this process.', ('cache',), misses),
+        ('cache_hit_ratio', 'Share of lookups served from the cache.', ('cache',), ratios)
+    ]
+
+# Connection pool usage, only available for a QueuePool (not SQLite).
+def pool_gauges():
+    status = pool_status()
+    if status is None:
+        return []
+    return [
+        ('db_pool_size', 'Configured number of pooled connections.', (), {(): status['size']}),
+        ('db_pool_checked_out', 'Connections currently checked out.', (), {(): status['checked_out']}),
+        ('db_pool_overflow', 'Connections open beyond the pool size.', (), {(): status['overflow']})
+    ]
+
+# Rents waiting for the write-behind queue, see writebehind.py.
+def write_behind_gauges():
+    return [
+        ('rent_queue_pending', 'Rents queued and not committed yet.', (), {(): rent_queue.pending()}),
+        ('rent_queue_rows', 'Rents committed by the write-behind queue.', (), {(): rent_queue.stats['rows']}),
+        ('rent_queue_batches', 'Transactions committed by the write-behind queue.', (), {(): rent_queue.stats['batches']}),
+        ('rent_queue_rejected', 'Rents rejected because the queue was full.', (), {(): rent_queue.stats['rejected']}),
+        ('rent_queue_dropped', 'Queued rents dropped because their request stopped waiting.', (), {(): rent_queue.stats['dropped']})
+    ]
+
+# The ISO 8601 date or time in the `name` argument as naive UTC, None when it is missing.
+def requested_time(name):
+    value = request.args.get(name)
+    if value is None:
+        return None
+    try:
+        parsed = datetime.fromisoformat(value)
+    except ValueError:
+        abort(400)
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+# Copies in stock sent by a client, a non negative integer or None to stop tracking them.
+def valid_available(value):
+    if value is not None and (not isinstance(value, int) or isinstance(value, bool) or value < 0):
+        raise ValueError('available must be a non negative integer or null')
+    return value
 
 def create_app(test_config=None):
     app = Flask(__name__)
     setup_db(app)
+    init_instrumentation(app)
+    init_metrics(app)
+    init_replicas(app, replica_set)
+    init_write_behind(app)
+    init_limits(app)
+    init_events(app)
+    registry.add_collector(cache_gauges)
+    registry.add_collector(pool_gauges)
+    if RENT_WRITE_BEHIND:
+        registry.add_collector(write_behind_gauges)
     CORS(app, resources={r"/" : {"origins": '*'}})
 
     @app.after_request
@@ -23,29 +131,150 @@ def create_app(test_config=None):
             "status": "App is working fine."
         })
 
+    # Prometheus metrics, merged across workers when METRICS_MULTIPROC_DIR is set.
+    @app.route('/metrics', methods=["GET"])
+    def get_metrics():
+        return Response(registry.render(), mimetype='text/plain; version=0.0.4')
+
+    # Connection pool usage of this worker.
+    @app.route('/pool-stats', methods=["GET"])
+    def get_pool_stats():
+        return jsonify({
+            'success': True,
+            'pid': os.getpid(),
+            'pool': pool_status(),
+            'replicas': replica_set.status(),
+            'rent_queue': dict(rent_queue.stats, pending=rent_queue.pending()) if RENT_WRITE_BEHIND else None,
+            'events': dict(broadcaster.stats, last_id=broadcaster.last)
+        })
+
+    # Hit ratios and sizes of the in-process caches.
+    @app.route('/cache-stats', methods=["GET"])
+    def cache_stats():
+        return jsonify({
+            'success': True,
+            'jwks': jwks_cache.stats,
+            'tokens': dict(token_cache.stats, size=len(token_cache)),
+            'responses': response_cache.stats,
+            'prices': price_catalog.snapshot_stats()
+        })
+
+    # Concurrency limits of this worker and how often they shed requests.
+    @app.route('/limits', methods=["GET"])
+    def get_limits():
+        return jsonify(dict(limits.status(), success=True, pid=os.getpid()))
+
+    # Changes the concurrency limits of the worker serving the request, requires 'update:limits' permission.
+    # Takes `budgets` (`read` / `write`), `routes` (by endpoint name) and `per_client`, see limits.py.
+    @app.route('/limits', methods=["PATCH"])
+    @requires_auth('update:limits')
+    def update_limits(userData):
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict):
+            abort(400)
+        try:
+            limits.configure(data)
+        except ValueError:
+            abort(422)
+        return jsonify(dict(limits.status(), success=True, pid=os.getpid()))
+
     # Get all movies no authorization required.
+    # Paginated with `limit` and `cursor`, sorted by `sort` (prefix with `-` for descending)
+    # and filtered by `min_price` / `max_price`. `fields` limits the columns selected and returned.
     @app.route("/movies", methods=['GET'])
+    @conditional('movies', 'inventory')
+    @use_replica
     def get_all_movies():
-        movies = Movies.query.all()
+        sort = request.args.get('sort', 'id')
+        descending = sort.startswith('-')
+        sort_key = sort.lstrip('-')
+        if sort_key not in MOVIE_SORTS:
+            abort(400)
+        columns = MOVIE_SORTS[sort_key]()
+        fields = requested_fields('fields', MOVIE_FIELDS)
+
+        limit = request.args.get('limit', MOVIES_PAGE_SIZE, type=int)
+        limit = max(1, min(limit, MOVIES_MAX_PAGE_SIZE))
+
+        # The sort columns are selected too, the next cursor is built from them.
+        selected = list(dict.fromkeys(fields + [c.key for c in columns]))
+        query = db.session.query(*[getattr(Movies, name) for name in selected])
+
+        min_price = request.args.get('min_price', type=int)
+        if min_price is not None:
+            query = query.filter(Movies.price >= min_price)
+        max_price = request.args.get('max_price', type=int)
+        if max_price is not None:
+            query = query.filter(Movies.price <= max_price)
+
+        cursor = request.args.get('cursor')
+        if cursor:
+            try:
+                values = decode_cursor(cursor, sort, columns)
+            except InvalidCursor:
+                abort(400)
+            query = query.filter(keyset_filter(columns, values, descending))
+
+        # Movies without a name or price come last, or first when descending.
+        movies = query.order_by(*keyset_order(columns, descending)).limit(limit + 1).all()
         if len(movies) == 0: 
             abort(404)
-        formatted_movies = [m.format() for m in movies]
+
+        next_cursor = None
+        if len(movies) > limit:
+            movies = movies[:limit]
+            last = movies[-1]
+            next_cursor = encode_cursor(sort, [getattr(last, c.key) for c in columns])
+        # The requested fields come first in every row, followed by any extra sort column.
+        encoded_movies = RowEncoder(fields).encode([m[:len(fields)] for m in movies])
+
+        return rows_response('movies', encoded_movies, {
+            "success": True,
+            "next_cursor": next_cursor
+        })
+
+    # Search movies by title, no authorization required.
+    # Finds titles starting with `q` and titles similar to it (typos), best matches first,
+    # paginated with `limit` and `offset`.
+    @app.route("/movies/search", methods=['GET'])
+    @conditional('movies')
+    @use_replica
+    def search_all_movies():
+        q = request.args.get('q', '').strip()
+        if not q:
+            abort(400)
+
+        limit = request.args.get('limit', MOVIES_PAGE_SIZE, type=int)
+        limit = max(1, min(limit, MOVIES_MAX_PAGE_SIZE))
+        offset = max(0, request.args.get('offset', 0, type=int))
+
+        try:
+            matches = search_movies(q, limit + 1, offset)
+        except:
+            abort(422)
 
         return jsonify({
             "success": True,
-            "movies": formatted_movies
+            "movies": [{
+                'id': movie_id,
+                'movie_name': name,
+                'price': price,
+                'score': round(score, 4)
+            } for movie_id, name, price, score in matches[:limit]],
+            "next_offset": offset + limit if len(matches) > limit else None
         })
 
     # Create a movie, requires 'create:movie' permission which only an admin have.
     @app.route("/create-movie", methods=["POST"])
     @requires_auth('create:movie')
+    @idempotent
     def create_movie(userData):
         try:
             data = request.get_json()
 
             if 'movie_name' and 'price' not in data:
                 abort(422)
-            movie = Movies(data['movie_name'], data['price'])
+            movie = Movies(data['movie_name'], data['price'], valid_available(data.get('available')))
             movie.insert()
             return jsonify({
                 'success': True,
@@ -55,12 +284,71 @@ def create_app(test_config=None):
         except:
             abort(422)
 
+    # Import many movies at once, requires 'create:movie' permission.
+    # Accepts a JSON array or an NDJSON stream (`Content-Type: application/x-ndjson`) of
+    # `{"movie_name", "price"}` objects. With `?mode=upsert` existing movies get their price updated.
+    @app.route("/movies/bulk", methods=["POST"])
+    @requires_auth('create:movie')
+    def bulk_create_movies(userData):
+        mode = request.args.get('mode', 'insert')
+        if mode not in ('insert', 'upsert'):
+            abort(400)
+
+        if request.mimetype == 'application/x-ndjson':
+            items = (line for line in request.stream if line.strip())
+        else:
+            items = request.get_json(silent=True)
+            if not isinstance(items, list):
+                abort(400)
+
+        errors = []
+        seen = set()
+
+        def valid_rows():
+            for i, item in enumerate(items):
+                if isinstance(item, bytes):
+                    try:
+                        item = json.loads(item)
+                    except ValueError:
+                        errors.append((i, 'invalid JSON'))
+                        continue
+
+                if not isinstance(item, dict):
+                    errors.append((i, 'expected an object'))
+                    continue
+                name, price = item.get('movie_name'), item.get('price')
+                if not isinstance(name, str) or not name.strip():
+                    errors.append((i, 'movie_name must be a non empty string'))
+                    continue
+                if not isinstance(price, int) or isinstance(price, bool) or price < 0:
+                    errors.append((i, 'price must be a non negative integer'))
+                    continue
+                if name in seen:
+                    errors.append((i, 'duplicate movie_name in request'))
+                    continue
+
+                seen.add(name)
+                yield i, {'movie_name': name, 'price': price}
+
+        try:
+            inserted, updated, conflicts = Movies.bulk_insert(valid_rows(), upsert=(mode == 'upsert'))
+        except:
+            abort(422)
+
+        errors = sorted(errors + conflicts)
+        return jsonify({
+            'success': True,
+            'inserted': inserted,
+            'updated': updated,
+            'errors': [{'row': i, 'message': message} for i, message in errors]
+        })
+
     # Updating a movie, requires 'update:movie' permission which only an admin have.
     @app.route("/movie/<int:id>", methods=["PATCH"])
     @requires_auth('update:movie')
     def update_movie(userData,id):
         data = request.get_json()
-        if 'movie_name' and 'price' not in data:
+        if not data or not {'movie_name', 'price', 'available'} & set(data):
             abort(400)
 
         movie = Movies.query.filter(Movies.id==id).one_or_none()
@@ -72,6 +360,11 @@ def create_app(test_config=None):
             movie.movie_name = data['movie_name']
         if 'price' in data:
             movie.price = data['price']
+        if 'available' in data:
+            try:
+                movie.available = valid_available(data['available'])
+            except ValueError:
+                abort(422)
 
         movie.update()
         return jsonify({
@@ -95,42 +388,249 @@ def create_app(test_config=None):
         })
 
     # Get all rented movies, no authentication required.
+    # Rents and their movies come from a single joined query, read in chunks through a
+    # server-side cursor and streamed out so memory stays flat however many rents exist.
+    # `fields` and `fields[movie]` limit the columns selected and returned. With `embed=movie`
+    # every movie is sent once in `embedded.movies` instead of inside each rent.
+    # `movie_id`, `from` and `to` (ISO 8601, `to` excluded) filter on the rents indexes.
     @app.route('/rented-movies', methods=['GET'])
+    @conditional('movies', 'rents', cache_body=False)
+    @use_replica
     def get_rented_movies():
+        fields = requested_fields('fields', RENT_FIELDS)
+        movie_fields = requested_fields('fields[movie]', MOVIE_FIELDS)
+        embed = request.args.get('embed')
+        if embed not in (None, 'movie'):
+            abort(400)
+
+        nested = 'movie' in fields and embed is None
+        rent_fields = [f for f in fields if f != 'movie']
+        if embed and 'movie_id' not in rent_fields:
+            rent_fields.append('movie_id')
+        selected = [getattr(Rents, f) for f in rent_fields]
+
+        filters = []
+        movie_id = request.args.get('movie_id', type=int)
+        if 'movie_id' in request.args and movie_id is None:
+            abort(400)
+        if movie_id is not None:
+            filters.append(Rents.movie_id == movie_id)
+        start, end = requested_time('from'), requested_time('to')
+        if start is not None:
+            filters.append(Rents.rented_at >= start)
+        if end is not None:
+            filters.append(Rents.rented_at < end)
+
         try:
-            data = Rents.query.join(Movies).all()
-            all_rented_movies = [r.format() for r in data]
+            if nested:
+                query = db.session.query(*selected, *[getattr(Movies, f) for f in movie_fields]).join(Rents.movie)
+            else:
+                # Same rents as the join, without reading movies.
+                query = db.session.query(*selected).filter(Rents.movie_id.isnot(None))
+            query = query.filter(*filters).order_by(Rents.id).yield_per(RENTS_CHUNK_SIZE)
+            rows = iter(query)
+            first = next(rows, None)
+
+        except:
+            abort(422)
+
+        encoder = RowEncoder(rent_fields, nested=('movie', movie_fields) if nested else None)
+        movie_ids = set()
+
+        def encode_chunk(chunk):
+            if embed:
+                index = rent_fields.index('movie_id')
+                movie_ids.update(row[index] for row in chunk)
+            return encoder.join(chunk)
+
+        def embedded_movies():
+            movies = {}
+            for batch in batches(sorted(movie_ids), RENTS_CHUNK_SIZE):
+                query = db.session.query(Movies.id, *[getattr(Movies, f) for f in movie_fields]) \
+                    .filter(Movies.id.in_(batch))
+                for row in query:
+                    movies[str(row[0])] = dict(zip(movie_fields, row[1:]))
+            return dumps({'movies': movies})
+
+        def generate():
+            yield b'{"movies":['
+            if first is not None:
+                chunk = [first]
+                separator = b''
+                for r in rows:
+                    if len(chunk) >= RENTS_CHUNK_SIZE:
+                        yield separator + encode_chunk(chunk)
+                        separator = b','
+                        chunk = []
+                    chunk.append(r)
+                yield separator + encode_chunk(chunk)
+            yield b']'
+            if embed:
+                yield b',"embedded":' + embedded_movies()
+            yield b',"success":true}'
 
+        return Response(stream_with_context(generate()), mimetype='application/json')
+
+    # Export every rent or movie as NDJSON or CSV, no authentication required.
+    # Streamed from a server-side cursor and gzipped when accepted, `after` resumes after an id.
+    @app.route('/export/rentals', methods=['GET'])
+    @use_replica
+    def export_rentals():
+        return export_response(Rents.__table__, ['id', 'movie_id', 'charges', 'rented_at'])
+
+    @app.route('/export/movies', methods=['GET'])
+    @use_replica
+    def export_movies():
+        return export_response(Movies.__table__, ['id', 'movie_name', 'price', 'available'])
+
+    # Rental analytics, no authentication required.
+    # Served from the per movie totals: the `top` movies by `sort` (`revenue` or `count`),
+    # or the totals of a single movie with `movie_id`.
+    @app.route('/analytics/rentals', methods=['GET'])
+    @conditional('movies', 'rents')
+    @use_replica
+    def get_rental_analytics():
+        movie_id = request.args.get('movie_id', type=int)
+        if movie_id is not None:
+            stats = RentalStats.query.get(movie_id)
+            if not stats:
+                abort(404)
             return jsonify({
                 'success': True,
-                'movies': all_rented_movies
+                'movie': stats.format()
             })
 
-        except:
-            abort(422)
+        sort = request.args.get('sort', 'revenue')
+        if sort not in ('revenue', 'count'):
+            abort(400)
+        top = max(1, min(request.args.get('top', 10, type=int), MOVIES_MAX_PAGE_SIZE))
+        order = RentalStats.total_charges if sort == 'revenue' else RentalStats.rent_count
+
+        rows = db.session.query(RentalStats, Movies.movie_name) \
+            .join(Movies, Movies.id == RentalStats.movie_id) \
+            .order_by(order.desc(), RentalStats.movie_id) \
+            .limit(top)
+        totals = db.session.query(
+            db.func.coalesce(db.func.sum(RentalStats.rent_count), 0),
+            db.func.coalesce(db.func.sum(RentalStats.total_charges), 0)).one()
+
+        return jsonify({
+            'success': True,
+            'movies': [dict(stats.format(), movie_name=name) for stats, name in rows],
+            'rent_count': int(totals[0]),
+            'total_charges': int(totals[1])
+        })
+
+    # Change feed of movies and rents as Server-Sent Events, no authentication required.
+    # Resumes after `Last-Event-ID` (or `last_event_id`), see events.py.
+    @app.route('/events', methods=['GET'])
+    def stream_events():
+        if not EVENTS_ENABLED:
+            abort(404)
+        last_id = request.headers.get('Last-Event-ID', request.args.get('last_event_id'))
+        if last_id is not None:
+            try:
+                last_id = int(last_id)
+            except ValueError:
+                abort(400)
+        if not broadcaster.try_connect():
+            abort(503)
+
+        def generate():
+            try:
+                for frame in event_stream(last_id):
+                    yield frame
+            finally:
+                broadcaster.disconnect()
+
+        response = Response(stream_with_context(generate()), mimetype='text/event-stream')
+        response.headers['Cache-Control'] = 'no-cache'
+        # Stops nginx from buffering the stream.
+        response.headers['X-Accel-Buffering'] = 'no'
+        return response
 
     # Rent a movie, requires 'rent:movie' permission which an authenticated user and admin has.
     @app.route('/rent-movie', methods=["POST"])
     @requires_auth('rent:movie')
+    @idempotent
     def rent_a_movie(userData):
         try:
             data = request.get_json()
             if 'movie_id' not in data or 'days' not in data:
                 abort(400)
             
-            movie = Movies.query.get(data['movie_id'])
-            charge = movie.price * data['days']
+            # Priced from the in-memory catalog, the only query left is the insert.
+            movie = price_catalog.get(int(data['movie_id']))
+            charge = movie['price'] * data['days']
 
-            rented_movie = Rents(movie_id=data['movie_id'], charges=charge)
-            rented_movie.insert()
+            if RENT_WRITE_BEHIND:
+                # Committed together with other queued rents, the id is known once it's stored.
+                rented_movie = rent_queue.rent(movie['id'], charge)
+            else:
+                rented_movie = Rents(movie_id=movie['id'], charges=charge).insert()
             return jsonify({
                 'success': True,
-                'rented_movie': rented_movie.format()
+                'rented_movie': rented_movie
             })
 
+        except QueueFull:
+            abort(503)
+        except RentPending:
+            # The rent may still be committed, a retry with the same key must not rent again.
+            keep_pending()
+            abort(503)
+        except SoldOut:
+            abort(409)
         except:
             abort(404)
 
+    # Rent several movies at once, requires 'rent:movie' permission.
+    # Takes `items`, a list of `{"movie_id", "days"}`, and rents all of them or none.
+    @app.route('/rent-movies', methods=["POST"])
+    @requires_auth('rent:movie')
+    @idempotent
+    def rent_many_movies(userData):
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict) or not isinstance(data.get('items'), list) or not data['items']:
+            abort(400)
+
+        items = []
+        for item in data['items']:
+            try:
+                movie_id, days = int(item['movie_id']), int(item['days'])
+            except (TypeError, KeyError, ValueError):
+                abort(400)
+            if days <= 0:
+                abort(400)
+            items.append((movie_id, days))
+
+        movies = price_catalog.get_many({m for m, _ in items})
+        if len(movies) < len({m for m, _ in items}):
+            abort(404)
+        prices = {movie_id: movie['price'] for movie_id, movie in movies.items()}
+
+        rents = [Rents(movie_id=movie_id, charges=prices[movie_id] * days) for movie_id, days in items]
+        try:
+            ids = [rent['id'] for rent in Rents.insert_many(rents)]
+        except SoldOut:
+            abort(409)
+        except:
+            abort(422)
+
+        rented_movies = [{
+            'id': rent_id,
+            'movie_id': movie_id,
+            'days': days,
+            'price': prices[movie_id],
+            'charges': prices[movie_id] * days
+        } for rent_id, (movie_id, days) in zip(ids, items)]
+
+        return jsonify({
+            'success': True,
+            'rented_movies': rented_movies,
+            'total_charges': sum(r['charges'] for r in rented_movies)
+        })
+
     # Handles not found error.
     @app.errorhandler(404)
     def handler_not_found(error):
@@ -167,6 +667,39 @@ def create_app(test_config=None):
             "message": "method not allowed"
         }), 405
 
+    # Handles conflicts, like a retry sent while the original request is still running.
+    @app.errorhandler(409)
+    def handler_conflict(error):
+        return jsonify({
+            "success": False,
+            "error": 409,
+            "message": "conflict"
+        }), 409
+
+    # Handles a client sending too many requests at once.
+    @app.errorhandler(429)
+    def handler_too_many_requests(error):
+        response = jsonify({
+            "success": False,
+            "error": 429,
+            "message": "too many requests"
+        })
+        response.status_code = 429
+        response.headers['Retry-After'] = str(RETRY_AFTER_SECONDS)
+        return response
+
+    # Handles overload, the client may retry after a short pause.
+    @app.errorhandler(503)
+    def handler_unavailable(error):
+        response = jsonify({
+            "success": False,
+            "error": 503,
+            "message": "service unavailable"
+        })
+        response.status_code = 503
+        response.headers['Retry-After'] = str(RETRY_AFTER_SECONDS)
+        return response
+
     # Handles AuthError which are defined in auth.py file.
     @app.errorhandler(AuthError)
     def handle_auth_error(err):
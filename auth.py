@@ -1,19 +1,190 @@
+import hashlib
 import json
+import logging
+import threading
+import time
 from flask import request, _request_ctx_stack
+from collections import OrderedDict
 from functools import wraps
 from jose import jwt
 from urllib.request import urlopen
 import os
+from metrics import AUTH_VERIFY_SECONDS
 
 AUTH0_DOMAIN = os.environ['AUTH0_DOMAIN']
 ALGORITHMS = ['RS256']
 API_AUDIENCE = os.environ['API_AUDIENCE']
 
+# JWKS_URL can point at a local file (file:///path/jwks.json) or a stub server for tests.
+JWKS_URL = os.environ.get('JWKS_URL', f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
+JWKS_CACHE_TTL = float(os.environ.get('JWKS_CACHE_TTL', 600))
+JWKS_MIN_REFETCH_INTERVAL = float(os.environ.get('JWKS_MIN_REFETCH_INTERVAL', 30))
+
+TOKEN_CACHE_MAX_ENTRIES = int(os.environ.get('TOKEN_CACHE_MAX_ENTRIES', 1024))
+TOKEN_CACHE_MAX_AGE = float(os.environ.get('TOKEN_CACHE_MAX_AGE', 300))
+
+logger = logging.getLogger(__name__)
+
 class AuthError(Exception):
     def __init__(self, error, status_code):
         self.error = error
         self.status_code = status_code
 
+'''
+In-process cache of the JWKS keyset, indexed by kid.
+Once the TTL has passed the stale keyset keeps being served while a background
+thread refreshes it. An unknown kid forces a synchronous refetch, but at most
+once every `min_refetch_interval` seconds so bogus tokens can't hammer Auth0.
+'''
+class JWKSCache:
+    def __init__(self, url, ttl=JWKS_CACHE_TTL, min_refetch_interval=JWKS_MIN_REFETCH_INTERVAL, timeout=5):
+        self.url = url
+        self.ttl = ttl
+        self.min_refetch_interval = min_refetch_interval
+        self.timeout = timeout
+        self.stats = {'hits': 0, 'misses': 0, 'refreshes': 0, 'forced_refreshes': 0, 'errors': 0}
+        self._keys = {}
+        self._fetched_at = None
+        self._last_forced = None
+        self._refreshing = False
+        self._lock = threading.Lock()
+
+    def _fetch(self):
+        with urlopen(self.url, timeout=self.timeout) as jsonurl:
+            jwks = json.loads(jsonurl.read())
+
+        keys = {}
+        for key in jwks['keys']:
+            if 'kid' not in key:
+                continue
+            keys[key['kid']] = {
+                'kty': key['kty'],
+                'kid': key['kid'],
+                'use': key.get('use'),
+                'n': key['n'],
+                'e': key['e']
+            }
+        self._keys = keys
+        self._fetched_at = time.monotonic()
+        self.stats['refreshes'] += 1
+
+    def _refresh(self):
+        try:
+            self._fetch()
+        except Exception:
+            self.stats['errors'] += 1
+            logger.exception('Unable to fetch JWKS from %s', self.url)
+            if self._fetched_at is None:
+                raise AuthError({
+                    'code': 'jwks_unavailable',
+                    'description': 'Unable to fetch signing keys.'
+                }, 503)
+
+    def _refresh_in_background(self):
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+
+        def run():
+            try:
+                self._refresh()
+            finally:
+                self._refreshing = False
+
+        threading.Thread(target=run, name='jwks-refresh', daemon=True).start()
+
+    def get_key(self, kid):
+        if self._fetched_at is None:
+            with self._lock:
+                if self._fetched_at is None:
+                    self._refresh()
+        elif time.monotonic() - self._fetched_at > self.ttl:
+            self._refresh_in_background()
+
+        key = self._keys.get(kid)
+        if key:
+            self.stats['hits'] += 1
+            return key
+
+        self.stats['misses'] += 1
+        with self._lock:
+            now = time.monotonic()
+            if self._last_forced is None or now - self._last_forced >= self.min_refetch_interval:
+                self._last_forced = now
+                self.stats['forced_refreshes'] += 1
+                self._refresh()
+        return self._keys.get(kid)
+
+    def clear(self):
+        with self._lock:
+            self._keys = {}
+            self._fetched_at = None
+            self._last_forced = None
+
+jwks_cache = JWKSCache(JWKS_URL)
+
+'''
+Bounded LRU cache of verified token payloads, keyed by a sha256 digest of the token
+so raw bearer tokens are never kept in memory. An entry lives until the token's `exp`
+claim or `max_age` seconds, whichever comes first.
+'''
+class TokenCache:
+    def __init__(self, max_entries=TOKEN_CACHE_MAX_ENTRIES, max_age=TOKEN_CACHE_MAX_AGE):
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'expirations': 0}
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _digest(token):
+        return hashlib.sha256(token.encode('utf-8')).digest()
+
+    def get(self, token):
+        digest = self._digest(token)
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry is None:
+                self.stats['misses'] += 1
+                return None
+
+            expires_at, payload = entry
+            if expires_at <= time.time():
+                del self._entries[digest]
+                self.stats['expirations'] += 1
+                self.stats['misses'] += 1
+                return None
+
+            self._entries.move_to_end(digest)
+            self.stats['hits'] += 1
+            return payload
+
+    def put(self, token, payload):
+        if self.max_entries <= 0:
+            return
+
+        expires_at = time.time() + self.max_age
+        if 'exp' in payload:
+            expires_at = min(expires_at, payload['exp'])
+
+        digest = self._digest(token)
+        with self._lock:
+            self._entries[digest] = (expires_at, payload)
+            self._entries.move_to_end(digest)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.stats['evictions'] += 1
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+token_cache = TokenCache()
+
 def get_token_auth_header():
     auth = request.headers.get('Authorization', None)
     if not auth:
@@ -59,25 +230,19 @@ def check_permissions(permission, payload):
     return True
 
 def verify_decode_jwt(token):
+    # Tokens verified before skip the signature check, permissions are still checked by the caller.
+    payload = token_cache.get(token)
+    if payload is not None:
+        return payload
+
     jwt_header_unverified = jwt.get_unverified_header(token)
-    rsa_key = {}
-    jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
-    jwks = json.loads(jsonurl.read())
     if 'kid' not in jwt_header_unverified:
         raise AuthError({
             'code': 'invalid_header',
             'description': 'Authorization malformed.'
         }, 401)
 
-    for key in jwks['keys']:
-        if key['kid'] == jwt_header_unverified['kid']:
-            rsa_key = {
-                'kty': key['kty'],
-                'kid': key['kid'],
-                'use': key['use'],
-                'n': key['n'],
-                'e': key['e']
-            }
+    rsa_key = jwks_cache.get_key(jwt_header_unverified['kid'])
     if rsa_key:
         try:
             payload = jwt.decode(
@@ -88,6 +253,7 @@ def verify_decode_jwt(token):
                 issuer='https://' + AUTH0_DOMAIN + '/'
             )
 
+            token_cache.put(token, payload)
             return payload
 
         except jwt.JWTClaimsError:
@@ -117,7 +283,13 @@ def requires_auth(permission=''):
         @wraps(f)
         def wrapper(*args, **kwargs):
             token = get_token_auth_header()
-            payload = verify_decode_jwt(token)
+            started = time.perf_counter()
+            try:
+                payload = verify_decode_jwt(token)
+            except Exception:
+                AUTH_VERIFY_SECONDS.observe(time.perf_counter() - started, 'error')
+                raise
+            AUTH_VERIFY_SECONDS.observe(time.perf_counter() - started, 'ok')
             check_permissions(permission, payload)
             return f(payload, *args, **kwargs)
 
@@ -0,0 +1,125 @@
+import argparse
+import json
+import os
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from urllib.error import URLError
+from urllib.request import urlopen
+
+from benchmarks.local_auth import setup_environment
+
+'''
+Boot time and cold request latency of the app under gunicorn, with the old setup (plain
+`gunicorn app:app`, every worker importing the app and running `create_all`) and with
+gunicorn.conf.py (preloaded app, `create_all` skipped on a migrated database).
+
+    python -m benchmarks.boot --workers 4 --runs 3
+
+For every setup it reports `boot_ms` (start until `/` answers), `ready_ms` (start until
+every worker has answered, the old setup boots workers one import at a time), the latency
+of the first `/movies` request of a worker (`cold_ms`) and of later ones (`warm_ms`), and
+how long it takes to replace killed workers (`respawn_ms`).
+The database is stamped with the newest migration so `create_all` can be skipped.
+'''
+
+SETUPS = {
+    # An empty config, gunicorn would pick up ./gunicorn.conf.py otherwise.
+    'before': {'args': ['-c', os.devnull], 'env': {'DB_CREATE_ALL': 'always'}},
+    'after': {'args': ['-c', 'gunicorn.conf.py'], 'env': {'DB_CREATE_ALL': 'auto'}},
+}
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def get(url):
+    started = time.perf_counter()
+    with urlopen(url, timeout=10) as response:
+        body = response.read()
+    return (time.perf_counter() - started) * 1000, body
+
+# Creates the tables, records the newest migration like `flask db upgrade` would and adds `movies` movies.
+def prepare_database(movies):
+    from app import app
+    from models import db, Movies, migration_heads
+
+    with app.app_context():
+        db.create_all()
+        Movies.bulk_insert((i, {'movie_name': f'boot-{i}', 'price': 100 + i}) for i in range(movies))
+        db.session.execute('CREATE TABLE IF NOT EXISTS alembic_version (version_num VARCHAR(32) NOT NULL)')
+        db.session.execute('DELETE FROM alembic_version')
+        for head in migration_heads():
+            db.session.execute('INSERT INTO alembic_version (version_num) VALUES (:head)', {'head': head})
+        db.session.commit()
+
+def measure(setup, workers, warm_requests):
+    port = free_port()
+    base_url = f'http://127.0.0.1:{port}'
+    env = dict(os.environ, GUNICORN_WORKERS=str(workers), GUNICORN_WORKER_CLASS='sync', **setup['env'])
+    command = [sys.executable, '-m', 'gunicorn', *setup['args'], '-b', f'127.0.0.1:{port}', '-w', str(workers), 'app:app']
+
+    started = time.perf_counter()
+    server = subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        pids = set()
+        boot = None
+        while len(pids) < workers:
+            if time.perf_counter() - started > 60:
+                raise RuntimeError('gunicorn did not start')
+            try:
+                _, body = get(base_url + '/pool-stats')
+            except (URLError, ConnectionError):
+                time.sleep(0.005)
+                continue
+            if boot is None:
+                boot = (time.perf_counter() - started) * 1000
+            pids.add(json.loads(body)['pid'])
+        ready = (time.perf_counter() - started) * 1000
+
+        cold, _ = get(base_url + '/movies')
+        warm = [get(base_url + f'/movies?limit={i % 50 + 1}')[0] for i in range(warm_requests)]
+
+        # Kill every worker and wait for a replacement to answer.
+        for pid in pids:
+            os.kill(pid, signal.SIGKILL)
+        killed = time.perf_counter()
+        while True:
+            try:
+                _, body = get(base_url + '/pool-stats')
+            except (URLError, ConnectionError):
+                time.sleep(0.005)
+                continue
+            if json.loads(body)['pid'] not in pids:
+                break
+        respawn = (time.perf_counter() - killed) * 1000
+        return {'boot_ms': boot, 'ready_ms': ready, 'cold_ms': cold, 'warm_ms': statistics.median(warm), 'respawn_ms': respawn}
+    finally:
+        server.terminate()
+        server.wait()
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--warm-requests', type=int, default=50)
+    parser.add_argument('--movies', type=int, default=1000, help='movies to seed')
+    args = parser.parse_args()
+
+    setup_environment(tempfile.mkdtemp(prefix='bench-'))
+    prepare_database(args.movies)
+
+    results = {}
+    for name, setup in SETUPS.items():
+        runs = [measure(setup, args.workers, args.warm_requests) for _ in range(args.runs)]
+        results[name] = {key: round(statistics.median(run[key] for run in runs), 1) for key in runs[0]}
+
+    print(json.dumps(dict(results, workers=args.workers, runs=args.runs), indent=2))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+import argparse
+import json
+import tempfile
+import time
+import uuid
+
+from benchmarks.local_auth import setup_environment, ADMIN_PERMISSIONS
+
+'''
+Compares importing movies one at a time through POST /create-movie with a single
+POST /movies/bulk call and prints rows/sec for both.
+
+    python -m benchmarks.bulk_import --rows 2000
+
+Runs against a throwaway SQLite database unless DATABASE_URL is set.
+'''
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=1000)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='bench-')
+    auth = setup_environment(workdir)
+    from app import create_app
+
+    app = create_app()
+    client = app.test_client()
+    headers = auth.headers(ADMIN_PERMISSIONS)
+    run = uuid.uuid4().hex[:8]
+
+    start = time.perf_counter()
+    for i in range(args.rows):
+        client.post('/create-movie', headers=headers, json={'movie_name': f'single-{run}-{i}', 'price': i % 500})
+    single = time.perf_counter() - start
+
+    body = '\n'.join(json.dumps({'movie_name': f'bulk-{run}-{i}', 'price': i % 500}) for i in range(args.rows))
+    start = time.perf_counter()
+    result = client.post('/movies/bulk', headers=headers, data=body, content_type='application/x-ndjson')
+    bulk = time.perf_counter() - start
+    assert result.get_json()['inserted'] == args.rows, result.get_json()
+
+    print(json.dumps({
+        'rows': args.rows,
+        'create_movie_rows_per_sec': round(args.rows / single, 1),
+        'bulk_rows_per_sec': round(args.rows / bulk, 1),
+        'speedup': round(single / bulk, 1)
+    }, indent=2))
+
+if __name__ == '__main__':
+    main()
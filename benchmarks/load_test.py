@@ -0,0 +1,176 @@
+import argparse
+import json
+import os
+import random
+import re
+import subprocess
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+from benchmarks.local_auth import setup_environment, ADMIN_PERMISSIONS, USER_PERMISSIONS
+
+'''
+Offline load test of the API endpoints. Builds the app with `create_app` against a local
+database, signs tokens with a local key served by a stub JWKS server, seeds the catalog and
+rentals, then drives every endpoint over HTTP at the given concurrency. Reports throughput,
+p50/p95/p99 latency and queries per request (from the Server-Timing header) and saves
+them as JSON so runs on different commits can be compared.
+
+    python -m benchmarks.load_test --movies 5000 --rents 50000 --concurrency 8 --output before.json
+    python -m benchmarks.load_test --movies 5000 --rents 50000 --concurrency 8 --compare before.json
+
+Runs against a throwaway SQLite database unless DATABASE_URL is set.
+'''
+
+ENDPOINTS = ('movies', 'rented-movies', 'rent-movie', 'create-movie')
+
+def percentile(values, p):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * len(ordered) + 0.5)) - 1)]
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def seed(app, movies, rents):
+    from models import db, Movies, Rents, RentalStats
+
+    with app.app_context():
+        run = uuid.uuid4().hex[:8]
+        Movies.bulk_insert((i, {'movie_name': f'seed-{run}-{i}', 'price': random.randint(50, 500)}) for i in range(movies))
+        movie_ids = [id for (id,) in db.session.query(Movies.id)]
+        for start in range(0, rents, 10000):
+            db.session.execute(Rents.__table__.insert(), [
+                {'movie_id': random.choice(movie_ids), 'charges': random.randint(50, 5000)}
+                for _ in range(min(10000, rents - start))
+            ])
+        db.session.commit()
+        RentalStats.rebuild()
+        return movie_ids
+
+def serve(app):
+    from werkzeug.serving import make_server
+
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def call(base_url, method, path, headers=None, body=None):
+    data = json.dumps(body).encode('utf-8') if body is not None else None
+    request = Request(base_url + path, data=data, method=method, headers=dict(headers or {}))
+    if data is not None:
+        request.add_header('Content-Type', 'application/json')
+
+    started = time.perf_counter()
+    try:
+        with urlopen(request) as response:
+            response.read()
+            status, timing = response.status, response.headers.get('Server-Timing', '')
+    except HTTPError as error:
+        error.read()
+        status, timing = error.code, error.headers.get('Server-Timing', '')
+    elapsed = time.perf_counter() - started
+
+    queries = re.search(r'desc="(\d+) queries"', timing)
+    return elapsed, status, int(queries.group(1)) if queries else None
+
+def run_endpoint(base_url, name, requests, concurrency, auth, movie_ids, page_size):
+    admin = auth.headers(ADMIN_PERMISSIONS, sub='bench|admin')
+    user = auth.headers(USER_PERMISSIONS, sub='bench|user')
+    run = uuid.uuid4().hex[:8]
+
+    def one(i):
+        if name == 'movies':
+            return call(base_url, 'GET', f'/movies?limit={page_size}')
+        if name == 'rented-movies':
+            return call(base_url, 'GET', '/rented-movies')
+        if name == 'rent-movie':
+            return call(base_url, 'POST', '/rent-movie', user, {'movie_id': random.choice(movie_ids), 'days': random.randint(1, 7)})
+        return call(base_url, 'POST', '/create-movie', admin, {'movie_name': f'bench-{run}-{i}', 'price': 100})
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(one, range(requests)))
+    wall = time.perf_counter() - started
+
+    latencies = [elapsed * 1000 for elapsed, _, _ in results]
+    queries = [q for _, _, q in results if q is not None]
+    return {
+        'requests': requests,
+        'errors': sum(1 for _, status, _ in results if status >= 400),
+        'throughput_rps': round(requests / wall, 1),
+        'p50_ms': round(percentile(latencies, 50), 2),
+        'p95_ms': round(percentile(latencies, 95), 2),
+        'p99_ms': round(percentile(latencies, 99), 2),
+        'queries_per_request': round(sum(queries) / len(queries), 2) if queries else None
+    }
+
+def compare(results, baseline_path):
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+
+    for name, current in results['endpoints'].items():
+        before = baseline['endpoints'].get(name)
+        if not before:
+            continue
+        changes = []
+        for key in ('throughput_rps', 'p50_ms', 'p95_ms', 'p99_ms', 'queries_per_request'):
+            if before.get(key) and current.get(key) is not None:
+                changes.append(f'{key} {before[key]} -> {current[key]} ({(current[key] - before[key]) / before[key]:+.1%})')
+        print(f'{name}: ' + ', '.join(changes))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--movies', type=int, default=1000, help='movies to seed')
+    parser.add_argument('--rents', type=int, default=5000, help='rentals to seed')
+    parser.add_argument('--requests', type=int, default=500, help='requests per endpoint')
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--page-size', type=int, default=50, help='limit used for GET /movies')
+    parser.add_argument('--endpoints', default=','.join(ENDPOINTS))
+    parser.add_argument('--output', help='write results to this JSON file')
+    parser.add_argument('--compare', help='JSON results of an earlier run to compare with')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='bench-')
+    auth = setup_environment(workdir, jwks='http')
+    # Query counts come from the Server-Timing header, streamed endpoints (/rented-movies) have none.
+    os.environ.setdefault('SQL_INSTRUMENTATION', '1')
+    from app import create_app
+
+    app = create_app()
+    movie_ids = seed(app, args.movies, args.rents)
+    server = serve(app)
+    base_url = f'http://127.0.0.1:{server.server_port}'
+
+    results = {
+        'commit': git_commit(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'config': vars(args),
+        'database': os.environ['DATABASE_URL'].split('://', 1)[0],
+        'endpoints': {}
+    }
+    for name in args.endpoints.split(','):
+        if name not in ENDPOINTS:
+            parser.error(f'unknown endpoint {name}')
+        results['endpoints'][name] = run_endpoint(
+            base_url, name, args.requests, args.concurrency, auth, movie_ids, args.page_size)
+    server.shutdown()
+
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        compare(results, args.compare)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+import base64
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from Crypto.PublicKey import RSA
+from jose import jwt
+
+'''
+Local stand-in for Auth0 so benchmarks run offline: a freshly generated RSA key, its JWKS
+written to a file or served by a stub HTTP server the app reads through JWKS_URL, and
+tokens signed with that key. `setup_environment()` has to run before the app modules
+are imported.
+'''
+
+AUTH0_DOMAIN = 'bench.local'
+API_AUDIENCE = 'Movie Rental API'
+KID = 'bench-key'
+
+ADMIN_PERMISSIONS = ['create:movie', 'update:movie', 'delete:movie', 'rent:movie']
+USER_PERMISSIONS = ['rent:movie']
+
+def b64_int(value):
+    raw = value.to_bytes((value.bit_length() + 7) // 8, 'big')
+    return base64.urlsafe_b64encode(raw).rstrip(b'=').decode('ascii')
+
+class LocalAuth:
+    def __init__(self, workdir):
+        self.key = RSA.generate(2048)
+        self.private_pem = self.key.export_key().decode('ascii')
+        self.jwks = {'keys': [{
+            'kty': 'RSA',
+            'kid': KID,
+            'use': 'sig',
+            'n': b64_int(self.key.n),
+            'e': b64_int(self.key.e)
+        }]}
+        self.jwks_path = os.path.join(workdir, 'jwks.json')
+        with open(self.jwks_path, 'w') as f:
+            json.dump(self.jwks, f)
+
+    # Serves the JWKS over HTTP on a free local port and returns its URL.
+    def serve_jwks(self):
+        body = json.dumps(self.jwks).encode('utf-8')
+
+        class JWKSHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(('127.0.0.1', 0), JWKSHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return f'http://127.0.0.1:{server.server_port}/.well-known/jwks.json'
+
+    def token(self, permissions, sub='bench|user', expires_in=3600):
+        now = int(time.time())
+        claims = {
+            'iss': f'https://{AUTH0_DOMAIN}/',
+            'aud': API_AUDIENCE,
+            'sub': sub,
+            'iat': now,
+            'exp': now + expires_in,
+            'permissions': permissions
+        }
+        return jwt.encode(claims, self.private_pem, algorithm='RS256', headers={'kid': KID})
+
+    def headers(self, permissions, **kwargs):
+        return {'Authorization': f'Bearer {self.token(permissions, **kwargs)}'}
+
+def setup_environment(workdir, jwks='file'):
+    auth = LocalAuth(workdir)
+    os.environ['AUTH0_DOMAIN'] = AUTH0_DOMAIN
+    os.environ['API_AUDIENCE'] = API_AUDIENCE
+    os.environ['JWKS_URL'] = auth.serve_jwks() if jwks == 'http' else f'file://{auth.jwks_path}'
+    os.environ.setdefault('DATABASE_URL', f'sqlite:///{os.path.join(workdir, "bench.db")}')
+    return auth
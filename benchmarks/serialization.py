@@ -0,0 +1,81 @@
+import argparse
+import json
+import tempfile
+import time
+
+from benchmarks.local_auth import setup_environment
+
+'''
+Compares encoding a page of movies and of rents with their movies through `format()` dicts
+and `jsonify` (the old path) with `serializers.RowEncoder` on row tuples, for every JSON
+encoder installed, and prints bytes/sec for each.
+
+    python -m benchmarks.serialization --rows 50000
+
+`pip install orjson` or `ujson` first to include them.
+'''
+
+def measure(encode, repeat):
+    body = encode()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        encode()
+    seconds = (time.perf_counter() - start) / repeat
+    return {
+        'bytes': len(body),
+        'ms': round(seconds * 1000, 2),
+        'mb_per_sec': round(len(body) / seconds / 1e6, 1)
+    }
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=20000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    setup_environment(tempfile.mkdtemp(prefix='bench-'))
+    from flask import jsonify
+    from app import create_app
+    from models import Movies, Rents
+    from serializers import RowEncoder, load_encoder
+
+    app = create_app()
+    movie_rows = [(i, f'Movie number {i}', i % 500, None if i % 3 else i % 7) for i in range(args.rows)]
+    rent_rows = [(i, i % 100, (i % 500) * 3) + movie_rows[i % 100] for i in range(args.rows)]
+
+    movies = [Movies(name, price, available) for _, name, price, available in movie_rows]
+    for movie, row in zip(movies, movie_rows):
+        movie.id = row[0]
+    rents = []
+    for rent_id, movie_id, charges, *_ in rent_rows:
+        rent = Rents(movie_id=movie_id, charges=charges)
+        rent.id, rent.movie = rent_id, movies[movie_id]
+        rents.append(rent)
+
+    encoders = []
+    for name in ('json', 'ujson', 'orjson'):
+        try:
+            encoders.append(load_encoder(name))
+        except ImportError:
+            pass
+
+    results = {}
+    with app.app_context():
+        results['movies'] = {'jsonify': measure(lambda: jsonify({'movies': [m.format() for m in movies]}).get_data(), args.repeat)}
+        results['rents'] = {'jsonify': measure(lambda: jsonify({'movies': [r.format() for r in rents]}).get_data(), args.repeat)}
+
+    movie_columns = ['id', 'movie_name', 'price', 'available']
+    for encoder in encoders:
+        movie_encoder = RowEncoder(movie_columns, encoder=encoder)
+        rent_encoder = RowEncoder(['id', 'movie_id', 'charges'], nested=('movie', movie_columns), encoder=encoder)
+        results['movies'][encoder[0]] = measure(lambda: movie_encoder.encode(movie_rows), args.repeat)
+        results['rents'][encoder[0]] = measure(lambda: rent_encoder.encode(rent_rows), args.repeat)
+
+    for timings in results.values():
+        for name, timing in timings.items():
+            timing['speedup'] = round(timings['jsonify']['ms'] / timing['ms'], 2)
+
+    print(json.dumps(dict(results, rows=args.rows), indent=2))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,219 @@
+import fcntl
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from flask import Response, g, request, make_response
+
+'''
+Version stamps for the catalog and a cache of serialized responses built on them.
+Every write to movies or rents bumps a named counter, the counters make up the ETag
+of the catalog endpoints and cached bodies are only served while their ETag is current.
+
+The counters live in a pluggable store so several gunicorn workers can share them,
+pick one with CATALOG_VERSION_STORE:
+  - `memory` (default): per process, fine for a single worker.
+  - `file:/path/to/versions.json`: a JSON file guarded by flock.
+  - `sqlite:/path/to/versions.db`: a tiny SQLite database.
+A `memory` store only sees the writes of its own process. gunicorn.conf.py sets
+APP_PROCESSES to its number of workers, with more than one the caches built on a `memory`
+store are bypassed rather than served stale.
+'''
+
+APP_PROCESSES = int(os.environ.get('APP_PROCESSES', 1))
+
+# Counters start from the current time so a restarted process never reuses old ETags.
+def initial_version():
+    return time.time_ns() // 1000
+
+class MemoryVersionStore:
+    def __init__(self, processes=APP_PROCESSES):
+        # Whether every write to the catalog goes through this store, caches check it.
+        self.sees_all_writes = processes <= 1
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    def get(self, name):
+        version = self._versions.get(name)
+        if version is None:
+            with self._lock:
+                version = self._versions.setdefault(name, initial_version())
+        return version
+
+    def bump(self, name):
+        with self._lock:
+            version = self._versions.get(name, initial_version()) + 1
+            self._versions[name] = version
+        return version
+
+class FileVersionStore:
+    sees_all_writes = True
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _read(f):
+        f.seek(0)
+        data = f.read()
+        return json.loads(data) if data else {}
+
+    def get(self, name):
+        try:
+            with open(self.path, 'r') as f:
+                fcntl.flock(f, fcntl.LOCK_SH)
+                versions = self._read(f)
+        except FileNotFoundError:
+            versions = {}
+
+        if name not in versions:
+            return self.bump(name, create_only=True)
+        return versions[name]
+
+    def bump(self, name, create_only=False):
+        with self._lock, open(self.path, 'a+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            versions = self._read(f)
+            if name in versions and create_only:
+                return versions[name]
+            versions[name] = versions[name] + 1 if name in versions else initial_version()
+            f.seek(0)
+            f.truncate()
+            f.write(json.dumps(versions))
+            f.flush()
+            return versions[name]
+
+class SQLiteVersionStore:
+    sees_all_writes = True
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._connect().execute(
+            'CREATE TABLE IF NOT EXISTS versions (name TEXT PRIMARY KEY, value INTEGER NOT NULL)')
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or getattr(self._local, 'pid', None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def get(self, name):
+        row = self._connect().execute('SELECT value FROM versions WHERE name = ?', (name,)).fetchone()
+        if row is None:
+            self._connect().execute(
+                'INSERT OR IGNORE INTO versions (name, value) VALUES (?, ?)', (name, initial_version()))
+            return self.get(name)
+        return row[0]
+
+    def bump(self, name):
+        conn = self._connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.execute(
+                'INSERT INTO versions (name, value) VALUES (?, ?) '
+                'ON CONFLICT(name) DO UPDATE SET value = value + 1', (name, initial_version()))
+            value = conn.execute('SELECT value FROM versions WHERE name = ?', (name,)).fetchone()[0]
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return value
+
+def version_store_from_url(url):
+    if url == 'memory':
+        return MemoryVersionStore()
+    if url.startswith('file:'):
+        return FileVersionStore(url[len('file:'):])
+    if url.startswith('sqlite:'):
+        return SQLiteVersionStore(url[len('sqlite:'):])
+    raise ValueError(f'Unknown CATALOG_VERSION_STORE: {url}')
+
+versions = version_store_from_url(os.environ.get('CATALOG_VERSION_STORE', 'memory'))
+
+'''
+Bounded LRU of serialized response bodies, keyed by request path and query string.
+An entry is only served while its ETag matches the current catalog versions.
+'''
+class ResponseCache:
+    def __init__(self, max_entries=int(os.environ.get('RESPONSE_CACHE_MAX_ENTRIES', 256))):
+        self.max_entries = max_entries
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, etag):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != etag:
+                self.stats['misses'] += 1
+                return None
+            self._entries.move_to_end(key)
+            self.stats['hits'] += 1
+            return entry
+
+    def put(self, key, etag, body, mimetype):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (etag, body, mimetype)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.stats['evictions'] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+response_cache = ResponseCache()
+
+def catalog_etag(names, key):
+    stamp = '-'.join(str(versions.get(name)) for name in names)
+    digest = hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+    return f'{stamp}-{digest}'
+
+'''
+Decorator for GET routes whose body only depends on the given catalog versions and the
+request URL. Answers `If-None-Match` with 304 and, unless `cache_body` is off, serves
+repeated requests from `response_cache`. Streamed responses get an ETag but are not cached,
+responses read from a replica get neither, and nothing is when the versions store doesn't see
+every write.
+'''
+def conditional(*names, cache_body=True):
+    def conditional_decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            if not versions.sees_all_writes:
+                return f(*args, **kwargs)
+            key = request.full_path
+            etag = catalog_etag(names, key)
+            if request.if_none_match.contains(etag):
+                response = Response(status=304)
+                response.set_etag(etag)
+                return response
+
+            if cache_body:
+                cached = response_cache.get(key, etag)
+                if cached:
+                    response = Response(cached[1], mimetype=cached[2])
+                    response.set_etag(etag)
+                    return response
+
+            response = make_response(f(*args, **kwargs))
+            # A replica may lag behind the versions, so what it returned can't be tagged with them.
+            if response.status_code == 200 and not g.get('read_from_replica'):
+                response.set_etag(etag)
+                if cache_body and not response.is_streamed:
+                    response_cache.put(key, etag, response.get_data(), response.mimetype)
+            return response
+
+        return wrapper
+    return conditional_decorator
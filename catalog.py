@@ -0,0 +1,95 @@
+import threading
+import time
+from cache import versions
+from models import db, Movies, movie_listeners
+
+'''
+In-process copy of the movie catalog (id -> (movie_name, price)) so renting doesn't need a
+SELECT to price a movie. It loads lazily on first use and is patched in place when this
+process writes a movie. Every lookup compares the shared 'prices' version with the one the
+map was built at, so a write made by another worker forces a reload instead of charging a
+stale price. That only works when the version store sees every write, with a `memory` store
+and several workers every lookup reads the movies from the database instead.
+'''
+class PriceCatalog:
+    def __init__(self, store=versions):
+        self.versions = store
+        self.stats = {'hits': 0, 'misses': 0, 'loads': 0, 'stale_reloads': 0, 'patches': 0, 'uncached': 0}
+        self._movies = None
+        self._version = None
+        self._loaded_at = None
+        self._lock = threading.Lock()
+
+    # `(id, movie_name, price)` of every movie, or of `movie_ids`.
+    def _rows(self, movie_ids=None):
+        query = db.session.query(Movies.id, Movies.movie_name, Movies.price)
+        if movie_ids is not None:
+            query = query.filter(Movies.id.in_(movie_ids))
+        return query
+
+    def _load(self):
+        version = self.versions.get('prices')
+        movies = {id: (name, price) for id, name, price in self._rows()}
+        self._movies, self._version, self._loaded_at = movies, version, time.monotonic()
+        self.stats['loads'] += 1
+
+    def _current(self):
+        version = self.versions.get('prices')
+        if self._movies is None or self._version != version:
+            with self._lock:
+                if self._movies is not None and self._version != version:
+                    self.stats['stale_reloads'] += 1
+                    self._load()
+                elif self._movies is None:
+                    self._load()
+        return self._movies
+
+    # `{id: (movie_name, price)}` of the `movie_ids` that exist.
+    def _lookup(self, movie_ids):
+        if not self.versions.sees_all_writes:
+            self.stats['uncached'] += 1
+            return {id: (name, price) for id, name, price in self._rows(list(set(movie_ids)))}
+        catalog = self._current()
+        return {id: catalog[id] for id in movie_ids if id in catalog}
+
+    # Returns the formatted movie or None when it doesn't exist.
+    def get(self, movie_id):
+        return self.get_many([movie_id]).get(movie_id)
+
+    # Returns formatted movies for every id that exists.
+    def get_many(self, movie_ids):
+        found = self._lookup(movie_ids)
+        if self.versions.sees_all_writes:
+            self.stats['hits'] += len(found)
+            self.stats['misses'] += len(set(movie_ids)) - len(found)
+        return {id: {'id': id, 'movie_name': name, 'price': price} for id, (name, price) in found.items()}
+
+    def on_movie_change(self, action, movie):
+        version = self.versions.bump('prices')
+        with self._lock:
+            # Only patch when no other process wrote in between, otherwise let the next lookup reload.
+            if self._movies is None or action == 'bulk' or self._version != version - 1:
+                return
+            if action == 'delete':
+                self._movies.pop(movie['id'], None)
+            else:
+                self._movies[movie['id']] = (movie['movie_name'], movie['price'])
+            self._version = version
+            self.stats['patches'] += 1
+
+    def snapshot_stats(self):
+        lookups = self.stats['hits'] + self.stats['misses']
+        return dict(
+            self.stats,
+            size=len(self._movies or ()),
+            hit_rate=self.stats['hits'] / lookups if lookups else None,
+            age_seconds=time.monotonic() - self._loaded_at if self._loaded_at else None
+        )
+
+    def clear(self):
+        with self._lock:
+            self._movies = None
+            self._version = None
+
+price_catalog = PriceCatalog()
+movie_listeners.append(price_catalog.on_movie_change)
@@ -0,0 +1,242 @@
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+from datetime import datetime, timedelta
+from sqlalchemy import select, func
+from cache import initial_version
+from models import db, Event, movie_listeners, rent_listeners, outbox_writers
+
+'''
+Change feed for `/events` (Server-Sent Events). Every committed movie create, update, delete
+or bulk import and every rent is published as an event with a sequence number, kept in a
+ring buffer of the last EVENTS_BUFFER_SIZE events that the open streams wait on. A client
+reconnecting with `Last-Event-ID` gets the events it missed, or a `reset` event telling it
+to refetch when they are no longer available.
+
+EVENTS_BACKEND picks where events come from:
+  - `memory` (default): published straight into the buffer of the worker that made the
+    change. Other workers don't see it, use this with a single worker.
+  - `database`: written to the `events` table in the transaction of the change, so an
+    event exists exactly when its change committed. A thread in every worker polls the
+    table every EVENTS_POLL_INTERVAL seconds into its buffer, so all workers stream the
+    same events with the same ids, and older ones can be replayed from the table. Rows
+    older than EVENTS_RETENTION_SECONDS are deleted, by the poller or after a write (at
+    most every tenth of the retention), or by `manage.py prune_events`.
+  - `off`: no events are kept and `/events` answers 404, gunicorn.conf.py's default.
+'''
+
+EVENTS_BACKEND = os.environ.get('EVENTS_BACKEND', 'memory')
+if EVENTS_BACKEND not in ('memory', 'database', 'off'):
+    raise ValueError(f'Unknown EVENTS_BACKEND: {EVENTS_BACKEND}')
+EVENTS_ENABLED = EVENTS_BACKEND != 'off'
+EVENTS_BUFFER_SIZE = int(os.environ.get('EVENTS_BUFFER_SIZE', 1000))
+EVENTS_POLL_INTERVAL = float(os.environ.get('EVENTS_POLL_INTERVAL', 0.5))
+EVENTS_RETENTION_SECONDS = int(os.environ.get('EVENTS_RETENTION_SECONDS', 3600))
+EVENTS_HEARTBEAT_SECONDS = float(os.environ.get('EVENTS_HEARTBEAT_SECONDS', 15))
+EVENTS_MAX_STREAM_SECONDS = float(os.environ.get('EVENTS_MAX_STREAM_SECONDS', 300))
+EVENTS_MAX_CLIENTS = int(os.environ.get('EVENTS_MAX_CLIENTS', 100))
+# How long the poller waits for a missing id to commit before skipping it (a rolled back insert).
+EVENTS_GAP_SECONDS = 2
+
+logger = logging.getLogger(__name__)
+
+class EventBroadcaster:
+    def __init__(self, size=EVENTS_BUFFER_SIZE, start=None, reset_ahead=True):
+        self.size = size
+        # Ids newer than the last event come from an earlier process, unless another worker is just ahead.
+        self.reset_ahead = reset_ahead
+        self.stats = {'published': 0, 'clients': 0, 'resets': 0}
+        # Events up to `evicted` are gone from the buffer, `last` is the newest one.
+        self.last = self.evicted = initial_version() if start is None else start
+        self._events = deque()
+        self._cond = threading.Condition()
+
+    def publish(self, type, data, seq=None):
+        with self._cond:
+            seq = self.last + 1 if seq is None else seq
+            self._events.append((seq, type, data))
+            self.last = seq
+            while len(self._events) > self.size:
+                self.evicted = self._events.popleft()[0]
+            self.stats['published'] += 1
+            self._cond.notify_all()
+        return seq
+
+    # Events after `last_id`, None when some of them have been evicted.
+    def since(self, last_id):
+        with self._cond:
+            if last_id < self.evicted or (self.reset_ahead and last_id > self.last):
+                return None
+            return [event for event in self._events if event[0] > last_id]
+
+    # Like `since`, waiting up to `timeout` seconds for an event when there is none yet.
+    def wait(self, last_id, timeout):
+        with self._cond:
+            if self.last <= last_id:
+                self._cond.wait(timeout)
+            return self.since(last_id)
+
+    def try_connect(self, limit=EVENTS_MAX_CLIENTS):
+        with self._cond:
+            if self.stats['clients'] >= limit:
+                return False
+            self.stats['clients'] += 1
+            return True
+
+    def disconnect(self):
+        with self._cond:
+            self.stats['clients'] -= 1
+
+'''
+Reads the `events` table into a broadcaster, one polling thread per worker process.
+'''
+class EventTable:
+    def __init__(self, broadcaster, app=None):
+        self.broadcaster = broadcaster
+        self.app = app
+        self._pid = None
+        self._lock = threading.Lock()
+        self._last_prune = 0.0
+
+    # Adds `(type, payload)` events to the current transaction with one executemany.
+    def write(self, events):
+        now = datetime.utcnow()
+        db.session.execute(Event.__table__.insert(),
+            [{'type': type, 'data': json.dumps(payload), 'created_at': now} for type, payload in events])
+
+    # Events after `last_id` read from the table, None when the older ones were deleted.
+    def read(self, last_id, limit):
+        table = Event.__table__
+        oldest = db.session.execute(select([func.min(table.c.id)])).scalar()
+        if oldest is None or oldest > last_id + 1:
+            return None
+        rows = db.session.execute(
+            select([table.c.id, table.c.type, table.c.data]).where(table.c.id > last_id).order_by(table.c.id).limit(limit))
+        return [tuple(row) for row in rows]
+
+    # The poller is started on first use and again in a forked worker.
+    def ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                with self.app.app_context():
+                    newest = db.session.execute(select([func.max(Event.__table__.c.id)])).scalar() or 0
+                    db.session.remove()
+                self.broadcaster.last = self.broadcaster.evicted = newest
+                threading.Thread(target=self._run, name='event-poller', daemon=True).start()
+                self._pid = os.getpid()
+
+    '''
+    Ids are taken when an event is inserted but become visible when it commits, so a
+    later id can show up first. Publishing stops at a missing id until it shows up or
+    EVENTS_GAP_SECONDS have passed, otherwise streams would skip it for good.
+    '''
+    def poll(self):
+        table = Event.__table__
+        rows = db.session.execute(select([table.c.id, table.c.type, table.c.data, table.c.created_at])
+            .where(table.c.id > self.broadcaster.last).order_by(table.c.id).limit(EVENTS_BUFFER_SIZE)).fetchall()
+        settled = datetime.utcnow() - timedelta(seconds=EVENTS_GAP_SECONDS)
+        for seq, type, data, created_at in rows:
+            if seq != self.broadcaster.last + 1 and created_at > settled:
+                break
+            self.broadcaster.publish(type, data, seq)
+
+    def _run(self):
+        while True:
+            time.sleep(EVENTS_POLL_INTERVAL)
+            try:
+                with self.app.app_context():
+                    self.poll()
+                    self.prune()
+                    db.session.remove()
+            except Exception:
+                logger.warning('Polling the events table failed', exc_info=True)
+
+    def prune(self):
+        if time.monotonic() - self._last_prune < EVENTS_RETENTION_SECONDS / 10:
+            return
+        self._last_prune = time.monotonic()
+        Event.prune(datetime.utcnow() - timedelta(seconds=EVENTS_RETENTION_SECONDS))
+
+    # Runs after a write commits, so the table is pruned even when no stream is open.
+    def prune_after_write(self, *args):
+        try:
+            self.prune()
+        except Exception:
+            logger.warning('Pruning the events table failed', exc_info=True)
+
+broadcaster = EventBroadcaster()
+event_table = None
+if EVENTS_BACKEND == 'database':
+    broadcaster.reset_ahead = False
+    event_table = EventTable(broadcaster)
+
+def publish(type, payload):
+    broadcaster.publish(type, json.dumps(payload))
+
+def on_movie_change(action, movie):
+    publish(f'movie.{action}', movie)
+
+def on_rents(rents):
+    for rent in rents:
+        publish('rent.insert', rent)
+
+def format_event(seq, type, data):
+    return f'id: {seq}\nevent: {type}\ndata: {data}\n\n'
+
+'''
+The event stream after `last_id` (from now on when None), ended after
+EVENTS_MAX_STREAM_SECONDS so the client reconnects with its Last-Event-ID.
+'''
+def event_stream(last_id=None):
+    if event_table is not None:
+        event_table.ensure_started()
+    if last_id is None:
+        last_id = broadcaster.last
+    # Ask browsers to wait a bit before reconnecting.
+    yield 'retry: 1000\n\n'
+
+    backlog = broadcaster.since(last_id)
+    if backlog is None and event_table is not None:
+        backlog = event_table.read(last_id, EVENTS_BUFFER_SIZE)
+        # Don't hold on to a connection for the whole stream.
+        db.session.close()
+    if backlog is None:
+        broadcaster.stats['resets'] += 1
+        last_id = broadcaster.last
+        yield format_event(last_id, 'reset', '{}')
+        backlog = []
+
+    deadline = time.monotonic() + EVENTS_MAX_STREAM_SECONDS
+    while True:
+        for seq, type, data in backlog:
+            yield format_event(seq, type, data)
+            last_id = seq
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return
+        backlog = broadcaster.wait(last_id, min(EVENTS_HEARTBEAT_SECONDS, remaining))
+        if backlog is None:
+            # This client fell further behind than the buffer holds.
+            broadcaster.stats['resets'] += 1
+            last_id = broadcaster.last
+            yield format_event(last_id, 'reset', '{}')
+            backlog = []
+        elif not backlog:
+            yield ': keepalive\n\n'
+
+def init_events(app):
+    if event_table is not None:
+        event_table.app = app
+
+if event_table is not None:
+    outbox_writers.append(event_table.write)
+    movie_listeners.append(event_table.prune_after_write)
+    rent_listeners.append(event_table.prune_after_write)
+elif EVENTS_ENABLED:
+    movie_listeners.append(on_movie_change)
+    rent_listeners.append(on_rents)
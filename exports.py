@@ -0,0 +1,93 @@
+import csv
+import io
+import os
+import zlib
+from flask import Response, request, abort, stream_with_context
+from sqlalchemy import select
+from models import db
+from serializers import RowEncoder
+
+'''
+Streaming exports of whole tables as NDJSON or CSV, picked with `format` or the `Accept`
+header. Rows are read in chunks of EXPORT_CHUNK_SIZE through a server-side cursor
+(`stream_results`, a named cursor on Postgres) in id order and written out chunk by chunk,
+gzipped on the fly when the client accepts it, so a worker's memory stays flat whatever
+the table size. `after=<id>` resumes an interrupted export after the last id received.
+'''
+
+EXPORT_CHUNK_SIZE = int(os.environ.get('EXPORT_CHUNK_SIZE', 1000))
+EXPORT_GZIP_LEVEL = int(os.environ.get('EXPORT_GZIP_LEVEL', 6))
+EXPORT_FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv'
+}
+
+def export_format():
+    fmt = request.args.get('format')
+    if fmt is not None:
+        if fmt not in EXPORT_FORMATS:
+            abort(400)
+        return fmt
+    best = request.accept_mimetypes.best_match(list(EXPORT_FORMATS.values()), default=EXPORT_FORMATS['ndjson'])
+    return next(name for name, mimetype in EXPORT_FORMATS.items() if mimetype == best)
+
+def fetch_chunks(result, size):
+    try:
+        while True:
+            rows = result.fetchmany(size)
+            if not rows:
+                return
+            yield rows
+    finally:
+        result.close()
+
+def ndjson_chunks(chunks, columns):
+    encoder = RowEncoder(columns)
+    for rows in chunks:
+        yield encoder.lines(rows)
+
+def csv_chunks(chunks, columns):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    for rows in chunks:
+        writer.writerows(rows)
+        yield buffer.getvalue().encode('utf-8')
+        buffer.seek(0)
+        buffer.truncate()
+
+# Every chunk is flushed so the client receives rows as they are read.
+def gzip_chunks(chunks):
+    compressor = zlib.compressobj(EXPORT_GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        yield compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    yield compressor.flush()
+
+'''
+Streams `columns` of `table` for the current request, ordered by its `id` column.
+'''
+def export_response(table, columns):
+    after = request.args.get('after', type=int)
+    if 'after' in request.args and after is None:
+        abort(400)
+    fmt = export_format()
+
+    query = select([table.c[name] for name in columns]).order_by(table.c.id)
+    if after is not None:
+        query = query.where(table.c.id > after)
+    try:
+        result = db.session.execute(query.execution_options(stream_results=True))
+    except:
+        abort(422)
+
+    encode = ndjson_chunks if fmt == 'ndjson' else csv_chunks
+    chunks = encode(fetch_chunks(result, EXPORT_CHUNK_SIZE), columns)
+    gzip = request.accept_encodings['gzip'] > 0
+    if gzip:
+        chunks = gzip_chunks(chunks)
+
+    response = Response(stream_with_context(chunks), mimetype=EXPORT_FORMATS[fmt])
+    response.vary.update(('Accept', 'Accept-Encoding'))
+    if gzip:
+        response.headers['Content-Encoding'] = 'gzip'
+    return response
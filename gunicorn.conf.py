@@ -0,0 +1,96 @@
+import multiprocessing
+import os
+import shutil
+import tempfile
+
+'''
+Gunicorn settings for production, used by the Procfile: `gunicorn -c gunicorn.conf.py app:app`.
+
+The app is imported once in the master (`preload_app`) and the workers are forked from it,
+so they boot without importing anything or touching the database. GUNICORN_WORKER_CLASS
+picks the workers:
+  - `sync` (default): one request at a time per worker, 2 * CPUs + 1 workers.
+  - `gthread`: GUNICORN_THREADS threads per worker (default `8`), one worker per CPU.
+    Keep the threads at or below DB_POOL_SIZE + DB_MAX_OVERFLOW.
+  - `gevent`: GUNICORN_WORKER_CONNECTIONS greenlets per worker (default `100`), one worker
+    per CPU. Needs `pip install gevent` (and `psycogreen` for non-blocking Postgres).
+WEB_CONCURRENCY (set by Heroku) or GUNICORN_WORKERS overrides the number of workers.
+
+`/events` is off (EVENTS_BACKEND defaults to `off`) unless EVENTS_BACKEND is set, then the
+workers default to `gthread` since every stream holds a worker as long as a client listens.
+EVENTS_MAX_CLIENTS defaults to half the threads or greenlets of a worker and to 0 (every
+stream gets 503) for `sync` workers.
+With more than one worker EVENTS_BACKEND must be `database`, and unless it is set
+CATALOG_VERSION_STORE becomes an SQLite file in a temporary directory removed on exit, the
+per-process `memory` defaults would leave each worker with its own versions.
+'''
+
+EVENTS_BACKEND = os.environ.setdefault('EVENTS_BACKEND', 'off')
+GUNICORN_WORKER_CLASS = os.environ.get('GUNICORN_WORKER_CLASS', 'sync' if EVENTS_BACKEND == 'off' else 'gthread')
+if GUNICORN_WORKER_CLASS not in ('sync', 'gthread', 'gevent'):
+    raise ValueError(f'Unknown GUNICORN_WORKER_CLASS: {GUNICORN_WORKER_CLASS}')
+
+if GUNICORN_WORKER_CLASS == 'gevent':
+    # Patched before the app is preloaded, or the locks and sockets it creates would block.
+    from gevent import monkey
+    monkey.patch_all()
+    try:
+        from psycogreen.gevent import patch_psycopg
+        patch_psycopg()
+    except ImportError:
+        pass
+
+cpus = multiprocessing.cpu_count()
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8000')}"
+worker_class = GUNICORN_WORKER_CLASS
+workers = int(os.environ.get('GUNICORN_WORKERS', os.environ.get('WEB_CONCURRENCY',
+    2 * cpus + 1 if GUNICORN_WORKER_CLASS == 'sync' else cpus)))
+
+# Set before the app is preloaded, the stores are picked when their modules are imported.
+os.environ['APP_PROCESSES'] = str(workers)
+state_dir = None
+if workers > 1:
+    if 'CATALOG_VERSION_STORE' not in os.environ:
+        state_dir = tempfile.mkdtemp(prefix='rentalapi-')
+        os.environ['CATALOG_VERSION_STORE'] = f'sqlite:{os.path.join(state_dir, "versions.db")}'
+    if EVENTS_BACKEND == 'memory':
+        raise ValueError(f'EVENTS_BACKEND=memory only works with one worker, not {workers}')
+
+threads = int(os.environ.get('GUNICORN_THREADS', 8 if GUNICORN_WORKER_CLASS == 'gthread' else 1))
+worker_connections = int(os.environ.get('GUNICORN_WORKER_CONNECTIONS', 100))
+# Every stream holds a thread or greenlet, at most half of them stream so the API keeps the rest.
+# A sync worker would be held entirely, there `/events` answers 503.
+os.environ.setdefault('EVENTS_MAX_CLIENTS', str({
+    'sync': 0, 'gthread': threads // 2, 'gevent': worker_connections // 2}[GUNICORN_WORKER_CLASS]))
+preload_app = True
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 30))
+graceful_timeout = int(os.environ.get('GUNICORN_GRACEFUL_TIMEOUT', 30))
+keepalive = int(os.environ.get('GUNICORN_KEEPALIVE', 5))
+# Restart workers now and then so a slow leak can't grow forever, `0` never restarts them.
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', 0))
+max_requests_jitter = max_requests // 10
+accesslog = os.environ.get('GUNICORN_ACCESS_LOG')
+
+# The master opened connections while preloading, close them before any worker is forked.
+def when_ready(server):
+    from app import app
+    from models import dispose_engine
+    dispose_engine(app)
+
+# Opens the worker's first connection now rather than during its first request.
+def post_fork(server, worker):
+    from app import app
+    from models import db, dispose_engine
+    dispose_engine(app)
+    with app.app_context():
+        db.engine.connect().close()
+
+# Commits the rents still queued by the write-behind writer before the worker exits.
+def worker_exit(server, worker):
+    from writebehind import rent_queue
+    rent_queue.drain()
+
+def on_exit(server):
+    if state_dir is not None:
+        shutil.rmtree(state_dir, ignore_errors=True)
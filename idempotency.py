@@ -0,0 +1,141 @@
+import hashlib
+import json
+import logging
+import os
+import time
+from datetime import datetime, timedelta
+from functools import wraps
+from flask import Response, g, request, abort, make_response
+from sqlalchemy.exc import IntegrityError
+from models import db, IdempotencyKey
+
+'''
+Idempotency keys for POST routes. A client that sends an `Idempotency-Key` header can retry
+the request safely: the first request stores its response under the key (scoped to the
+caller's JWT `sub`), a retry with the same key and body gets that response back, with
+`Idempotent-Replayed: true`, without running the route again.
+
+Requests are claimed by inserting the key, so of two concurrent duplicates the unique
+constraint lets one through and the other gets 409 until the first is done. Reusing a key
+with a different body is a 422. Error responses are not stored, the request can be retried,
+unless the route called `keep_pending` because its write may still land: then retries get
+409 until the key is abandoned.
+
+Keys expire after IDEMPOTENCY_TTL_SECONDS, expired keys are swept at most every
+IDEMPOTENCY_SWEEP_INTERVAL seconds, and a key left unfinished for
+IDEMPOTENCY_PENDING_TIMEOUT seconds (a crashed worker) can be claimed again.
+'''
+
+IDEMPOTENCY_HEADER = 'Idempotency-Key'
+IDEMPOTENCY_TTL_SECONDS = int(os.environ.get('IDEMPOTENCY_TTL_SECONDS', 86400))
+IDEMPOTENCY_PENDING_TIMEOUT = int(os.environ.get('IDEMPOTENCY_PENDING_TIMEOUT', 60))
+IDEMPOTENCY_SWEEP_INTERVAL = float(os.environ.get('IDEMPOTENCY_SWEEP_INTERVAL', 300))
+MAX_KEY_LENGTH = 255
+
+logger = logging.getLogger(__name__)
+
+_last_sweep = 0.0
+
+# Same method, path and JSON body (whatever its key order) give the same fingerprint.
+def request_fingerprint():
+    body = request.get_json(silent=True)
+    payload = json.dumps(body, sort_keys=True) if body is not None else request.get_data(as_text=True)
+    return hashlib.sha256(f'{request.method} {request.path}\n{payload}'.encode('utf-8')).hexdigest()
+
+def sweep_expired(now):
+    global _last_sweep
+    if time.monotonic() - _last_sweep < IDEMPOTENCY_SWEEP_INTERVAL:
+        return
+    _last_sweep = time.monotonic()
+    try:
+        IdempotencyKey.sweep(now)
+    except Exception:
+        logger.warning('Sweeping expired idempotency keys failed', exc_info=True)
+
+def key_filter(owner, key):
+    return IdempotencyKey.query.filter_by(owner=owner, key=key)
+
+'''
+Claims `key` for this request. Returns None when the request may run, or the stored row
+of an earlier request with the same key.
+'''
+def claim(owner, key, fingerprint, now):
+    for _ in range(3):
+        try:
+            db.session.add(IdempotencyKey(owner=owner, key=key, fingerprint=fingerprint, created_at=now,
+                                          expires_at=now + timedelta(seconds=IDEMPOTENCY_TTL_SECONDS)))
+            db.session.commit()
+            return None
+        except IntegrityError:
+            db.session.rollback()
+
+        existing = key_filter(owner, key).first()
+        if existing is None:
+            continue
+        abandoned = existing.status_code is None and \
+            existing.created_at < now - timedelta(seconds=IDEMPOTENCY_PENDING_TIMEOUT)
+        if existing.expires_at >= now and not abandoned:
+            return existing
+
+        # Only the request that still sees the old row removes it, then everyone races to insert again.
+        key_filter(owner, key).filter_by(created_at=existing.created_at).delete(synchronize_session=False)
+        db.session.commit()
+    abort(409)
+
+def store(owner, key, response):
+    key_filter(owner, key).update({
+        'status_code': response.status_code,
+        'body': response.get_data(as_text=True),
+        'mimetype': response.mimetype
+    }, synchronize_session=False)
+    db.session.commit()
+
+def release(owner, key):
+    db.session.rollback()
+    key_filter(owner, key).filter(IdempotencyKey.status_code.is_(None)).delete(synchronize_session=False)
+    db.session.commit()
+
+# Keeps this request's key claimed even though it fails, for a write that may still be committed.
+def keep_pending():
+    g.idempotency_keep_pending = True
+
+'''
+Decorator for POST routes, placed below `requires_auth` so it receives the token payload.
+'''
+def idempotent(f):
+    @wraps(f)
+    def wrapper(payload, *args, **kwargs):
+        key = request.headers.get(IDEMPOTENCY_HEADER)
+        if key is None:
+            return f(payload, *args, **kwargs)
+        if not key or len(key) > MAX_KEY_LENGTH:
+            abort(400)
+
+        owner = payload.get('sub', '')
+        now = datetime.utcnow()
+        fingerprint = request_fingerprint()
+        sweep_expired(now)
+        existing = claim(owner, key, fingerprint, now)
+        if existing is not None:
+            if existing.fingerprint != fingerprint:
+                abort(422)
+            if existing.status_code is None:
+                abort(409)
+            response = Response(existing.body, status=existing.status_code, mimetype=existing.mimetype)
+            response.headers['Idempotent-Replayed'] = 'true'
+            return response
+
+        try:
+            response = make_response(f(payload, *args, **kwargs))
+        except:
+            if not g.get('idempotency_keep_pending'):
+                release(owner, key)
+            raise
+
+        if response.status_code < 400 and not response.is_streamed:
+            store(owner, key, response)
+        elif not g.get('idempotency_keep_pending'):
+            release(owner, key)
+        return response
+
+    return wrapper
@@ -0,0 +1,125 @@
+import logging
+import os
+import random
+import threading
+import time
+from collections import Counter
+from flask import request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from metrics import METRICS_ENABLED, DB_QUERY_SECONDS
+
+'''
+Per-request SQL instrumentation built on SQLAlchemy engine events.
+For a sampled request it counts the statements issued and the time spent in the database,
+reports them in a `Server-Timing` header and warns when the same parameterized statement
+runs more than SQL_N_PLUS_ONE_THRESHOLD times (usually an N+1 query). Statements slower
+than SQL_SLOW_QUERY_MS are logged whether the request was sampled or not.
+
+Nothing is recorded unless SQL_INSTRUMENTATION=1, SQL_SAMPLE_RATE keeps the cost down
+when it is left on in production.
+'''
+
+SQL_INSTRUMENTATION = os.environ.get('SQL_INSTRUMENTATION', '0') == '1'
+SQL_SAMPLE_RATE = float(os.environ.get('SQL_SAMPLE_RATE', 1.0))
+SQL_SERVER_TIMING = os.environ.get('SQL_SERVER_TIMING', '1') == '1'
+SQL_N_PLUS_ONE_THRESHOLD = int(os.environ.get('SQL_N_PLUS_ONE_THRESHOLD', 10))
+SQL_SLOW_QUERY_MS = float(os.environ.get('SQL_SLOW_QUERY_MS', 200))
+SQL_SLOWEST_KEPT = int(os.environ.get('SQL_SLOWEST_KEPT', 3))
+
+logger = logging.getLogger(__name__)
+slow_logger = logging.getLogger('sql.slow')
+
+_local = threading.local()
+_installed = False
+
+class RequestStats:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.count = 0
+        self.duration = 0.0
+        self.statements = Counter()
+        self.slowest = []
+
+    def record(self, statement, duration):
+        self.count += 1
+        self.duration += duration
+        self.statements[statement] += 1
+        if len(self.slowest) < SQL_SLOWEST_KEPT or duration > self.slowest[-1][0]:
+            self.slowest.append((duration, statement))
+            self.slowest.sort(key=lambda s: s[0], reverse=True)
+            del self.slowest[SQL_SLOWEST_KEPT:]
+
+    def server_timing(self):
+        return (f'db;dur={self.duration * 1000:.2f};desc="{self.count} queries", '
+                f'app;dur={(time.perf_counter() - self.started) * 1000:.2f}')
+
+def current_stats():
+    return getattr(_local, 'stats', None)
+
+# A connection runs one statement at a time, so a single start time per connection is enough.
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info['query_started'] = time.perf_counter()
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info.pop('query_started', None)
+    if started is None:
+        return
+    duration = time.perf_counter() - started
+
+    stats = current_stats()
+    if stats is not None:
+        stats.record(statement, duration)
+    if METRICS_ENABLED:
+        DB_QUERY_SECONDS.observe(duration)
+
+    if duration * 1000 >= SQL_SLOW_QUERY_MS:
+        slow_logger.warning('Slow query (%.1f ms): %s', duration * 1000, statement)
+
+# A statement that raised never reaches after_cursor_execute, drop its start time here.
+def handle_error(context):
+    if context.connection is not None:
+        context.connection.info.pop('query_started', None)
+
+def install_engine_hooks():
+    global _installed
+    if not _installed:
+        # Listening on the Engine class covers every engine, replicas included.
+        event.listen(Engine, 'before_cursor_execute', before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', after_cursor_execute)
+        event.listen(Engine, 'handle_error', handle_error)
+        _installed = True
+
+def init_instrumentation(app):
+    # The hooks also feed the database time reported on /metrics.
+    if SQL_INSTRUMENTATION or METRICS_ENABLED:
+        install_engine_hooks()
+    if not SQL_INSTRUMENTATION:
+        return
+
+    @app.before_request
+    def start_sql_stats():
+        _local.stats = RequestStats() if random.random() < SQL_SAMPLE_RATE else None
+
+    # Headers are sent before a streamed body runs its queries, so those responses get none.
+    @app.after_request
+    def add_server_timing(response):
+        stats = current_stats()
+        if stats is not None and SQL_SERVER_TIMING and not response.is_streamed:
+            response.headers.add('Server-Timing', stats.server_timing())
+        return response
+
+    # Runs once a streamed response is done, so its queries are included.
+    @app.teardown_request
+    def report_sql_stats(exc):
+        stats = current_stats()
+        _local.stats = None
+        if stats is None:
+            return
+
+        for statement, count in stats.statements.items():
+            if count > SQL_N_PLUS_ONE_THRESHOLD:
+                logger.warning('Possible N+1 query on %s %s: statement ran %d times: %s',
+                               request.method, request.path, count, statement)
+        logger.debug('%s %s issued %d queries in %.1f ms, slowest: %s', request.method, request.path,
+                     stats.count, stats.duration * 1000, [round(d * 1000, 1) for d, _ in stats.slowest])
@@ -0,0 +1,225 @@
+import os
+import threading
+import time
+from flask import g, request, abort
+from jose import jwt
+from metrics import REQUESTS_SHED
+
+'''
+Concurrency limits and load shedding. Every route gets its own limit on requests in flight
+with a bounded queue in front of it, sized from one of two budgets: `read` for GET routes
+(public) and `write` for everything else (authenticated). A request that finds the queue
+full, or waits in it longer than the budget's timeout, is shed with 503 and `Retry-After`,
+so a slow Auth0 or database makes requests fail fast instead of piling up in the workers.
+A single client (the JWT `sub`) with more than LIMIT_PER_CLIENT requests in flight gets 429.
+
+The limits are checked before the token is verified, so the `sub` is read without
+verifying the token. The limits apply per worker process and only bite with threaded or
+gevent workers. They can be changed at runtime with `PATCH /limits`.
+'''
+
+LOAD_SHEDDING = os.environ.get('LOAD_SHEDDING', '1') == '1'
+LIMIT_PER_CLIENT = int(os.environ.get('LIMIT_PER_CLIENT', 16))
+
+BUDGETS = {
+    'read': {
+        'limit': int(os.environ.get('LIMIT_READ_CONCURRENCY', 64)),
+        'queue': int(os.environ.get('LIMIT_READ_QUEUE', 128)),
+        'timeout': float(os.environ.get('LIMIT_READ_QUEUE_TIMEOUT', 2))
+    },
+    'write': {
+        'limit': int(os.environ.get('LIMIT_WRITE_CONCURRENCY', 16)),
+        'queue': int(os.environ.get('LIMIT_WRITE_QUEUE', 32)),
+        'timeout': float(os.environ.get('LIMIT_WRITE_QUEUE_TIMEOUT', 5))
+    }
+}
+
+# Cheap endpoints that must keep answering under load, and the long lived event stream which
+# has its own cap (EVENTS_MAX_CLIENTS).
+EXEMPT_ENDPOINTS = {'check_app', 'get_metrics', 'get_pool_stats', 'cache_stats', 'get_limits', 'update_limits', 'stream_events', 'static'}
+
+class ConcurrencyLimiter:
+    def __init__(self, limit, queue, timeout):
+        self.limit = limit
+        self.queue = queue
+        self.timeout = timeout
+        self.active = 0
+        self.waiting = 0
+        self.stats = {'admitted': 0, 'queued': 0, 'shed': 0, 'timeouts': 0}
+        self._cond = threading.Condition()
+
+    # True once the request may run, False when it has to be shed.
+    def acquire(self):
+        with self._cond:
+            if self.active < self.limit:
+                self.active += 1
+                self.stats['admitted'] += 1
+                return True
+            if self.waiting >= self.queue:
+                self.stats['shed'] += 1
+                return False
+
+            self.waiting += 1
+            self.stats['queued'] += 1
+            try:
+                deadline = time.monotonic() + self.timeout
+                while self.active >= self.limit:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.stats['timeouts'] += 1
+                        return False
+                    self._cond.wait(remaining)
+                self.active += 1
+                self.stats['admitted'] += 1
+                return True
+            finally:
+                self.waiting -= 1
+
+    def release(self):
+        with self._cond:
+            self.active -= 1
+            self._cond.notify()
+
+    def configure(self, limit=None, queue=None, timeout=None):
+        with self._cond:
+            if limit is not None:
+                self.limit = limit
+            if queue is not None:
+                self.queue = queue
+            if timeout is not None:
+                self.timeout = timeout
+            # A raised limit lets queued requests in right away.
+            self._cond.notify_all()
+
+    def status(self):
+        return dict(self.stats, limit=self.limit, queue=self.queue, timeout=self.timeout,
+                    active=self.active, waiting=self.waiting)
+
+class Limits:
+    def __init__(self, budgets=BUDGETS, per_client=LIMIT_PER_CLIENT):
+        self.budgets = {name: dict(budget) for name, budget in budgets.items()}
+        self.per_client = per_client
+        self.limiters = {}
+        self.clients = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def budget_for(method):
+        return 'read' if method in ('GET', 'HEAD') else 'write'
+
+    def limiter(self, endpoint, method):
+        key = (endpoint, self.budget_for(method))
+        limiter = self.limiters.get(key)
+        if limiter is None:
+            with self._lock:
+                limiter = self.limiters.get(key)
+                if limiter is None:
+                    limiter = self.limiters[key] = ConcurrencyLimiter(**self.budgets[key[1]])
+        return limiter
+
+    def enter_client(self, client):
+        with self._lock:
+            if self.clients.get(client, 0) >= self.per_client:
+                return False
+            self.clients[client] = self.clients.get(client, 0) + 1
+            return True
+
+    def leave_client(self, client):
+        with self._lock:
+            count = self.clients.pop(client) - 1
+            if count:
+                self.clients[client] = count
+
+    '''
+    Changes the limits, `changes` looks like the output of `status()`: budgets by name,
+    routes by `endpoint` (both budgets) or `endpoint:budget`, and `per_client`.
+    Budget changes apply to every route using that budget. Raises ValueError on bad input.
+    '''
+    def configure(self, changes):
+        def settings(values):
+            if not isinstance(values, dict) or not set(values) <= {'limit', 'queue', 'timeout'}:
+                raise ValueError('expected limit, queue and timeout')
+            for name, value in values.items():
+                if not isinstance(value, (int, float)) or isinstance(value, bool) or value < 0:
+                    raise ValueError(f'{name} must be a non-negative number')
+            return {name: int(value) if name != 'timeout' else float(value) for name, value in values.items()}
+
+        budgets = {name: settings(values) for name, values in changes.get('budgets', {}).items()}
+        if not set(budgets) <= set(self.budgets):
+            raise ValueError('unknown budget')
+        routes = []
+        for route, values in changes.get('routes', {}).items():
+            endpoint, _, budget = route.partition(':')
+            if budget and budget not in self.budgets:
+                raise ValueError('unknown budget')
+            routes += [(endpoint, name, settings(values)) for name in ([budget] if budget else self.budgets)]
+        per_client = changes.get('per_client')
+        if per_client is not None and (not isinstance(per_client, int) or per_client < 1):
+            raise ValueError('per_client must be a positive integer')
+
+        with self._lock:
+            for name, values in budgets.items():
+                self.budgets[name].update(values)
+                for (_, budget), limiter in self.limiters.items():
+                    if budget == name:
+                        limiter.configure(**values)
+            for endpoint, name, values in routes:
+                limiter = self.limiters.get((endpoint, name))
+                if limiter is None:
+                    limiter = self.limiters[(endpoint, name)] = ConcurrencyLimiter(**self.budgets[name])
+                limiter.configure(**values)
+            if per_client is not None:
+                self.per_client = per_client
+
+    def status(self):
+        return {
+            'budgets': self.budgets,
+            'per_client': self.per_client,
+            'routes': {f'{endpoint}:{budget}': limiter.status() for (endpoint, budget), limiter in self.limiters.items()}
+        }
+
+limits = Limits()
+
+# The JWT `sub` of the request, unverified, None for anonymous requests.
+def client_identity():
+    auth = request.headers.get('Authorization', '')
+    parts = auth.split()
+    if len(parts) != 2 or parts[0].lower() != 'bearer':
+        return None
+    try:
+        return jwt.get_unverified_claims(parts[1]).get('sub')
+    except Exception:
+        return None
+
+def init_limits(app):
+    if not LOAD_SHEDDING:
+        return
+
+    @app.before_request
+    def enter_limits():
+        if request.endpoint is None or request.endpoint in EXEMPT_ENDPOINTS or request.method == 'OPTIONS':
+            return
+        route = request.url_rule.rule
+
+        client = client_identity()
+        if client is not None:
+            if not limits.enter_client(client):
+                REQUESTS_SHED.inc(route, 'client')
+                abort(429)
+            g.limit_client = client
+
+        limiter = limits.limiter(request.endpoint, request.method)
+        if not limiter.acquire():
+            REQUESTS_SHED.inc(route, 'overload')
+            abort(503)
+        g.limiter = limiter
+
+    # Runs once a streamed response is done, so a stream holds its slot until the end.
+    @app.teardown_request
+    def leave_limits(exc):
+        limiter = g.pop('limiter', None)
+        if limiter is not None:
+            limiter.release()
+        client = g.pop('limit_client', None)
+        if client is not None:
+            limits.leave_client(client)
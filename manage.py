@@ -1,14 +1,45 @@
-from models import Rents, Movies
+import os
+from datetime import datetime, timedelta
+from models import Rents, Movies, RentalStats, IdempotencyKey, Event, BULK_BATCH_SIZE
 from flask_script import Manager
 from flask_migrate import Migrate, MigrateCommand
 
 from app import app
 from models import db
+from events import EVENTS_RETENTION_SECONDS
 
 migrate = Migrate(app, db)
 manager = Manager(app)
 
 manager.add_command('db', MigrateCommand)
 
+# Changes made here bump the versions in this process, a server on another store keeps its cached responses.
+def warn_if_unshared():
+  if os.environ.get('CATALOG_VERSION_STORE', 'memory') == 'memory':
+    print('CATALOG_VERSION_STORE is per process, restart the API so it stops serving cached rentals')
+
+# Recomputes the rental totals per movie from the rents table.
+@manager.command
+def rebuild_rental_stats():
+  RentalStats.rebuild()
+  warn_if_unshared()
+
+# Rolls rents from before `before` (ISO 8601 date, UTC) into monthly totals and deletes them.
+@manager.option('-b', '--before', dest='before', required=True)
+@manager.option('-s', '--batch-size', dest='batch_size', type=int, default=BULK_BATCH_SIZE)
+def archive_rents(before, batch_size):
+  print(f'Archived {Rents.archive(datetime.fromisoformat(before), batch_size)} rents')
+  warn_if_unshared()
+
+# Deletes expired idempotency keys, the API also does this every IDEMPOTENCY_SWEEP_INTERVAL seconds.
+@manager.command
+def sweep_idempotency_keys():
+  print(f'Deleted {IdempotencyKey.sweep(datetime.utcnow())} expired keys')
+
+# Deletes events older than EVENTS_RETENTION_SECONDS, the API also does this after writes.
+@manager.command
+def prune_events():
+  print(f'Deleted {Event.prune(datetime.utcnow() - timedelta(seconds=EVENTS_RETENTION_SECONDS))} events')
+
 if __name__ == '__main__':
   manager.run()
\ No newline at end of file
@@ -0,0 +1,240 @@
+import bisect
+import glob
+import json
+import os
+import threading
+import time
+from flask import g, request
+
+'''
+Small Prometheus style metrics registry, rendered in the text exposition format by `/metrics`.
+Counters and histograms are updated under a per metric lock held for a dict update only.
+Gauges are read from collector callbacks at scrape time.
+
+With METRICS_MULTIPROC_DIR set every gunicorn worker writes a snapshot of its metrics to
+that directory (at most every METRICS_FLUSH_INTERVAL seconds) and a scrape, whichever
+worker serves it, merges all snapshots. Counters and histograms are summed, gauges get
+a `pid` label. The directory should be emptied when the server starts.
+'''
+
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', '1') == '1'
+METRICS_MULTIPROC_DIR = os.environ.get('METRICS_MULTIPROC_DIR')
+METRICS_FLUSH_INTERVAL = float(os.environ.get('METRICS_FLUSH_INTERVAL', 5))
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Counter:
+    type = 'counter'
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            return dict(self._values)
+
+class Histogram:
+    type = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    # Values are stored as per bucket (not cumulative) counts followed by the sum.
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(labels)
+            if counts is None:
+                counts = self._values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[index] += 1
+            counts[-1] += value
+
+    def samples(self):
+        with self._lock:
+            return {labels: list(counts) for labels, counts in self._values.items()}
+
+class Registry:
+    def __init__(self, multiproc_dir=METRICS_MULTIPROC_DIR):
+        self.multiproc_dir = multiproc_dir
+        self.metrics = []
+        self.collectors = []
+        self._last_flush = 0.0
+
+    def counter(self, name, help, labelnames=()):
+        metric = Counter(name, help, labelnames)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        metric = Histogram(name, help, labelnames, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    '''
+    Adds a callback returning gauges as `(name, help, labelnames, {labels: value})` tuples,
+    it is called on every scrape and snapshot.
+    '''
+    def add_collector(self, collector):
+        if collector not in self.collectors:
+            self.collectors.append(collector)
+
+    def snapshot(self):
+        families = {}
+        for metric in self.metrics:
+            families[metric.name] = {
+                'type': metric.type,
+                'help': metric.help,
+                'labelnames': list(metric.labelnames),
+                'buckets': list(getattr(metric, 'buckets', ())),
+                'samples': [[list(labels), value] for labels, value in metric.samples().items()]
+            }
+        for collector in self.collectors:
+            for name, help, labelnames, values in collector():
+                families[name] = {
+                    'type': 'gauge',
+                    'help': help,
+                    'labelnames': list(labelnames),
+                    'buckets': [],
+                    'samples': [[list(labels), value] for labels, value in values.items()]
+                }
+        return families
+
+    def snapshot_path(self, pid=None):
+        return os.path.join(self.multiproc_dir, f'metrics-{pid or os.getpid()}.json')
+
+    def flush(self, force=False):
+        if not self.multiproc_dir:
+            return
+        now = time.monotonic()
+        if not force and now - self._last_flush < METRICS_FLUSH_INTERVAL:
+            return
+        self._last_flush = now
+
+        path = self.snapshot_path()
+        with open(path + '.tmp', 'w') as f:
+            json.dump(self.snapshot(), f)
+        os.replace(path + '.tmp', path)
+
+    # Snapshots of every worker, this process' own taken live.
+    def _snapshots(self):
+        if not self.multiproc_dir:
+            return [(os.getpid(), self.snapshot())]
+
+        snapshots = [(os.getpid(), self.snapshot())]
+        own = self.snapshot_path()
+        for path in glob.glob(os.path.join(self.multiproc_dir, 'metrics-*.json')):
+            if path == own:
+                continue
+            try:
+                with open(path) as f:
+                    snapshots.append((int(path.rsplit('-', 1)[1][:-len('.json')]), json.load(f)))
+            except (OSError, ValueError):
+                continue
+        return snapshots
+
+    def merged(self):
+        merged = {}
+        for pid, snapshot in self._snapshots():
+            for name, family in snapshot.items():
+                target = merged.setdefault(name, dict(family, samples={}))
+                gauge = family['type'] == 'gauge'
+                if gauge and self.multiproc_dir and not process_alive(pid):
+                    continue
+
+                labelnames = family['labelnames'] + ['pid'] if gauge and self.multiproc_dir else family['labelnames']
+                target['labelnames'] = labelnames
+                for labels, value in family['samples']:
+                    key = tuple(labels) + (str(pid),) if gauge and self.multiproc_dir else tuple(labels)
+                    if family['type'] == 'histogram':
+                        current = target['samples'].get(key)
+                        target['samples'][key] = value if current is None else [a + b for a, b in zip(current, value)]
+                    elif family['type'] == 'counter':
+                        target['samples'][key] = target['samples'].get(key, 0) + value
+                    else:
+                        target['samples'][key] = value
+        return merged
+
+    def render(self):
+        lines = []
+        for name, family in sorted(self.merged().items()):
+            lines.append(f'# HELP {name} {family["help"]}')
+            lines.append(f'# TYPE {name} {family["type"]}')
+            for labels, value in sorted(family['samples'].items()):
+                pairs = list(zip(family['labelnames'], labels))
+                if family['type'] != 'histogram':
+                    lines.append(f'{name}{format_labels(pairs)} {format_value(value)}')
+                    continue
+
+                cumulative = 0
+                for bound, count in zip(list(family['buckets']) + ['+Inf'], value[:-1]):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{format_labels(pairs + [("le", bound)])} {cumulative}')
+                lines.append(f'{name}_sum{format_labels(pairs)} {format_value(value[-1])}')
+                lines.append(f'{name}_count{format_labels(pairs)} {cumulative}')
+        return '\n'.join(lines) + '\n'
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def format_labels(pairs):
+    if not pairs:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + '}'
+
+def format_value(value):
+    if value is None:
+        return 'NaN'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+registry = Registry()
+
+HTTP_REQUESTS = registry.counter(
+    'http_requests_total', 'HTTP requests by route, method and status.', ('route', 'method', 'status'))
+HTTP_REQUEST_SECONDS = registry.histogram(
+    'http_request_duration_seconds', 'Time to produce a response, by route and method.', ('route', 'method'))
+AUTH_VERIFY_SECONDS = registry.histogram(
+    'auth_verify_seconds', 'Time spent in verify_decode_jwt.', ('outcome',))
+DB_QUERY_SECONDS = registry.histogram(
+    'db_query_duration_seconds', 'Time spent executing SQL statements.')
+REQUESTS_SHED = registry.counter(
+    'http_requests_shed_total', 'Requests rejected by the concurrency limits, by route and reason.', ('route', 'reason'))
+DB_POOL_WAIT_SECONDS = registry.histogram(
+    'db_pool_checkout_wait_seconds', 'Time spent waiting to check a connection out of the pool.')
+
+def init_metrics(app):
+    if not METRICS_ENABLED:
+        return
+
+    @app.before_request
+    def start_request_timer():
+        g.request_started = time.perf_counter()
+
+    @app.after_request
+    def record_request(response):
+        started = g.pop('request_started', None)
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        HTTP_REQUESTS.inc(route, request.method, str(response.status_code))
+        if started is not None:
+            HTTP_REQUEST_SECONDS.observe(time.perf_counter() - started, route, request.method)
+        registry.flush()
+        return response
@@ -0,0 +1,27 @@
+"""add movies.available inventory column
+
+Revision ID: 2e6d4a8f0b93
+Revises: 9c3e5b7a1f48
+Create Date: 2026-10-18 15:10:44.902116
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '2e6d4a8f0b93'
+down_revision = '9c3e5b7a1f48'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Nullable, existing movies stay untracked until an admin sets their copies.
+    op.add_column('movies', sa.Column('available', sa.Integer(), nullable=True))
+    op.create_check_constraint('ck_movies_available', 'movies', 'available >= 0')
+
+
+def downgrade():
+    op.drop_constraint('ck_movies_available', 'movies', type_='check')
+    op.drop_column('movies', 'available')
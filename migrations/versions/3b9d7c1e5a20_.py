@@ -0,0 +1,26 @@
+"""add indexes for movie ordering
+
+Revision ID: 3b9d7c1e5a20
+Revises: 84fea051b1f6
+Create Date: 2026-10-18 10:12:41.532118
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3b9d7c1e5a20'
+down_revision = '84fea051b1f6'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_movies_movie_name_id', 'movies', ['movie_name', 'id'], unique=False)
+    op.create_index('ix_movies_price_id', 'movies', ['price', 'id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_movies_price_id', table_name='movies')
+    op.drop_index('ix_movies_movie_name_id', table_name='movies')
@@ -0,0 +1,32 @@
+"""add events table for the change feed
+
+Revision ID: 4b8e2f6a9d31
+Revises: 2e6d4a8f0b93
+Create Date: 2026-10-18 16:02:17.418305
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4b8e2f6a9d31'
+down_revision = '2e6d4a8f0b93'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('events',
+    sa.Column('id', sa.BigInteger().with_variant(sa.Integer(), 'sqlite'), nullable=False),
+    sa.Column('type', sa.String(length=32), nullable=False),
+    sa.Column('data', sa.Text(), nullable=False),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_events_created_at'), 'events', ['created_at'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_events_created_at'), table_name='events')
+    op.drop_table('events')
@@ -0,0 +1,31 @@
+"""add trigram index for movie title search
+
+Revision ID: 5d2e8a7c4b13
+Revises: 3b9d7c1e5a20
+Create Date: 2026-10-18 11:02:17.845361
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5d2e8a7c4b13'
+down_revision = '3b9d7c1e5a20'
+branch_labels = None
+depends_on = None
+
+
+# Only Postgres has pg_trgm, other databases use the in-process index in search.py.
+def upgrade():
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+    op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    op.create_index('ix_movies_movie_name_trgm', 'movies', ['movie_name'], unique=False,
+                    postgresql_using='gin', postgresql_ops={'movie_name': 'gin_trgm_ops'})
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+    op.drop_index('ix_movies_movie_name_trgm', table_name='movies')
@@ -0,0 +1,40 @@
+"""add rents.rented_at with its indexes and the rent_rollups table
+
+Revision ID: 6f1a3c8e5b27
+Revises: 4b8e2f6a9d31
+Create Date: 2026-10-18 17:24:51.730962
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '6f1a3c8e5b27'
+down_revision = '4b8e2f6a9d31'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Existing rents get the time of the migration, new ones are stamped by the application.
+    op.add_column('rents', sa.Column('rented_at', sa.DateTime(), nullable=False,
+        server_default=sa.text("(now() at time zone 'utc')")))
+    op.alter_column('rents', 'rented_at', server_default=None)
+    op.create_index('ix_rents_movie_id_rented_at', 'rents', ['movie_id', 'rented_at'], unique=False)
+    op.create_index('ix_rents_rented_at', 'rents', ['rented_at'], unique=False)
+    op.create_table('rent_rollups',
+    sa.Column('movie_id', sa.Integer(), nullable=False),
+    sa.Column('month', sa.Date(), nullable=False),
+    sa.Column('rent_count', sa.Integer(), nullable=False),
+    sa.Column('total_charges', sa.BigInteger(), nullable=False),
+    sa.ForeignKeyConstraint(['movie_id'], ['movies.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('movie_id', 'month')
+    )
+
+
+def downgrade():
+    op.drop_table('rent_rollups')
+    op.drop_index('ix_rents_rented_at', table_name='rents')
+    op.drop_index('ix_rents_movie_id_rented_at', table_name='rents')
+    op.drop_column('rents', 'rented_at')
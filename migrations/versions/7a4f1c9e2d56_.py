@@ -0,0 +1,36 @@
+"""add rental_stats summary table
+
+Revision ID: 7a4f1c9e2d56
+Revises: 5d2e8a7c4b13
+Create Date: 2026-10-18 12:21:08.310254
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7a4f1c9e2d56'
+down_revision = '5d2e8a7c4b13'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('rental_stats',
+    sa.Column('movie_id', sa.Integer(), nullable=False),
+    sa.Column('rent_count', sa.Integer(), nullable=False),
+    sa.Column('total_charges', sa.BigInteger(), nullable=False),
+    sa.ForeignKeyConstraint(['movie_id'], ['movies.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('movie_id')
+    )
+    # Backfill from the existing rents.
+    op.execute(
+        'INSERT INTO rental_stats (movie_id, rent_count, total_charges) '
+        'SELECT movie_id, COUNT(*), COALESCE(SUM(charges), 0) FROM rents '
+        'WHERE movie_id IS NOT NULL GROUP BY movie_id'
+    )
+
+
+def downgrade():
+    op.drop_table('rental_stats')
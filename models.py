@@ -1,12 +1,184 @@
 import os
-from sqlalchemy import Column, String, Integer, create_engine
-from flask_sqlalchemy import SQLAlchemy
+import re
+import time
+from datetime import datetime, date
+from itertools import islice
+from collections import Counter
+from sqlalchemy import Column, String, Integer, BigInteger, Text, Date, DateTime, CheckConstraint, Index, create_engine, select, and_, or_, bindparam, event, exc, func
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from flask import g
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
 import json
+from sqlalchemy import orm, union_all
 from sqlalchemy.orm import relationship
+from sqlalchemy.pool import Pool, QueuePool
+from cache import versions
+from metrics import DB_POOL_WAIT_SECONDS
+from replicas import ReplicaSet, DATABASE_REPLICA_URLS, reads_from_replica
 
 database_path = os.environ['DATABASE_URL']
+BULK_BATCH_SIZE = int(os.environ.get('BULK_BATCH_SIZE', 1000))
 
-db = SQLAlchemy()
+# Connection pool settings, ignored for SQLite.
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 5))
+DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 10))
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 30))
+DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', 1800))
+DB_POOL_PRE_PING = os.environ.get('DB_POOL_PRE_PING', '1') == '1'
+DB_STATEMENT_TIMEOUT_MS = int(os.environ.get('DB_STATEMENT_TIMEOUT_MS', 0))
+# `auto` runs create_all only when the database isn't at the newest migration, `always` or `never`.
+DB_CREATE_ALL = os.environ.get('DB_CREATE_ALL', 'auto')
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrations')
+
+'''
+Session that sends the reads of routes decorated with `replicas.use_replica` to a replica,
+everything else, and every flush, goes to the primary.
+'''
+class RoutingSession(SignallingSession):
+    def get_bind(self, mapper=None, clause=None):
+        if replica_set and not self._flushing and reads_from_replica():
+            engine = replica_set.choose()
+            if engine is not None:
+                g.read_from_replica = True
+                return engine
+        return super().get_bind(mapper, clause)
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+db = RoutingSQLAlchemy()
+
+'''
+Callbacks run after a write to movies has been committed, called as `listener(action, movie)`.
+`action` is 'insert', 'update' or 'delete' with `movie` the formatted movie as committed,
+or 'bulk' with `movie` set to None when many rows changed at once.
+'''
+movie_listeners = []
+
+def notify_movie_listeners(action, movie):
+    for listener in movie_listeners:
+        listener(action, movie)
+
+'''
+Callbacks run after rents have been committed, called as `listener(rents)` with the rents
+formatted without their movie.
+'''
+rent_listeners = []
+
+def notify_rent_listeners(rents):
+    for listener in rent_listeners:
+        listener(rents)
+
+'''
+Callbacks run inside the transaction of a write just before it commits, called as
+`writer(events)` with a list of `(type, payload)` like 'movie.update' and the formatted
+movie. What they add to the session commits or rolls back together with the write.
+'''
+outbox_writers = []
+
+def write_outbox(events):
+    for writer in outbox_writers:
+        writer(events)
+
+'''
+QueuePool that records how long each checkout waited for a connection.
+'''
+class TimedQueuePool(QueuePool):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.waits = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            waited = time.perf_counter() - started
+            self.waits += 1
+            self.wait_seconds += waited
+            self.max_wait_seconds = max(self.max_wait_seconds, waited)
+            DB_POOL_WAIT_SECONDS.observe(waited)
+
+    def recreate(self):
+        pool = super().recreate()
+        pool.waits, pool.wait_seconds, pool.max_wait_seconds = self.waits, self.wait_seconds, self.max_wait_seconds
+        return pool
+
+'''
+Engine options built from the DB_POOL_* settings.
+'''
+def engine_options(database_path):
+    if database_path.startswith('sqlite'):
+        return {}
+
+    options = {
+        'poolclass': TimedQueuePool,
+        'pool_size': DB_POOL_SIZE,
+        'max_overflow': DB_MAX_OVERFLOW,
+        'pool_timeout': DB_POOL_TIMEOUT,
+        'pool_recycle': DB_POOL_RECYCLE,
+        'pool_pre_ping': DB_POOL_PRE_PING,
+    }
+    if DB_STATEMENT_TIMEOUT_MS and database_path.startswith('postgres'):
+        options['connect_args'] = {'options': f'-c statement_timeout={DB_STATEMENT_TIMEOUT_MS}'}
+    return options
+
+replica_set = ReplicaSet(DATABASE_REPLICA_URLS, engine_options)
+
+'''
+Connections must never be shared between processes. `app = create_app()` runs at import,
+so with gunicorn's preload the master opens connections that every forked worker inherits.
+Each connection remembers the pid that opened it and a checkout from any other process
+discards it and opens a fresh one instead.
+'''
+@event.listens_for(Pool, 'connect')
+def remember_connection_pid(dbapi_connection, connection_record):
+    connection_record.info['pid'] = os.getpid()
+
+@event.listens_for(Pool, 'checkout')
+def check_connection_pid(dbapi_connection, connection_record, connection_proxy):
+    pid = os.getpid()
+    if connection_record.info.get('pid', pid) != pid:
+        # Drop the inherited connection without closing it, the parent still owns the socket.
+        connection_record.connection = connection_proxy.connection = None
+        raise exc.DisconnectionError(
+            f"Connection record belongs to pid {connection_record.info['pid']}, attempting to check out in pid {pid}")
+
+'''
+Closes the pooled connections of this process, call it in the gunicorn master before
+workers are forked and again in `post_fork`.
+'''
+def dispose_engine(app):
+    with app.app_context():
+        db.engine.dispose()
+    for replica in replica_set.replicas:
+        replica.engine.dispose()
+
+'''
+Usage of the connection pool, None for SQLite which doesn't use a QueuePool.
+'''
+def pool_status():
+    pool = db.engine.pool
+    if not isinstance(pool, QueuePool):
+        return None
+
+    status = {
+        'size': pool.size(),
+        'checked_in': pool.checkedin(),
+        'checked_out': pool.checkedout(),
+        'overflow': max(pool.overflow(), 0),
+        'max_overflow': pool._max_overflow,
+    }
+    if isinstance(pool, TimedQueuePool):
+        status.update({
+            'checkouts': pool.waits,
+            'wait_seconds_total': round(pool.wait_seconds, 6),
+            'wait_seconds_max': round(pool.max_wait_seconds, 6),
+        })
+    return status
 
 '''
 Setup database and initialize it.
@@ -14,60 +186,428 @@ Setup database and initialize it.
 def setup_db(app, database_path=database_path):
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(database_path)
     db.app = app
     db.init_app(app)
+    create_schema()
+
+'''
+Revisions in migrations/versions that no other revision builds on. Read with a regular
+expression, importing alembic for this would add more to the boot than create_all costs.
+'''
+def migration_heads():
+    revisions, parents = set(), set()
+    versions_dir = os.path.join(MIGRATIONS_DIR, 'versions')
+    for name in os.listdir(versions_dir):
+        if not name.endswith('.py'):
+            continue
+        with open(os.path.join(versions_dir, name)) as f:
+            source = f.read()
+        revision = re.search(r"^revision = '(\w+)'", source, re.M)
+        if revision:
+            revisions.add(revision.group(1))
+        down = re.search(r"^down_revision = (.+)$", source, re.M)
+        if down:
+            parents.update(re.findall(r"'(\w+)'", down.group(1)))
+    return revisions - parents
+
+'''
+True when the database has been migrated to the newest revision in migrations/versions,
+read from the `alembic_version` table with a single query.
+'''
+def migrations_current():
+    try:
+        with db.engine.connect() as connection:
+            applied = {row[0] for row in connection.execute('SELECT version_num FROM alembic_version')}
+    except exc.DBAPIError:
+        return False
+    return applied == migration_heads()
+
+'''
+Creates missing tables. `create_all` reflects every table, which every worker of a
+migrated database would do at boot for nothing, so with DB_CREATE_ALL=auto it is skipped
+when the migrations are current.
+'''
+def create_schema():
+    if DB_CREATE_ALL == 'never' or (DB_CREATE_ALL == 'auto' and migrations_current()):
+        return
     db.create_all()
 
+'''
+Splits an iterable into lists of at most `size` items.
+'''
+def batches(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
 # Movies table with self methods
 class Movies(db.Model):  
   __tablename__ = 'movies'
+  __table_args__ = (
+    db.Index('ix_movies_movie_name_id', 'movie_name', 'id'),
+    db.Index('ix_movies_price_id', 'price', 'id'),
+    CheckConstraint('available >= 0', name='ck_movies_available'),
+  )
 
   id = Column(Integer, primary_key=True)
   movie_name = Column(String, unique=True)
   price = Column(Integer)
+  # Copies left to rent, NULL when the movie's inventory isn't tracked.
+  available = Column(Integer, nullable=True)
 
-  def __init__(self, movie_name, price):
+  def __init__(self, movie_name, price, available=None):
     self.movie_name = movie_name
     self.price = price
+    self.available = available
 
   def insert(self):
     db.session.add(self)
-    db.session.commit()
+    db.session.flush()
+    self.commit('insert')
   
   def update(self):
-    db.session.commit()
+    self.commit('update')
 
   def delete(self):
     db.session.delete(self)
+    self.commit('delete')
+
+  # Commits and lets listeners know, the movie is formatted first since commit expires it.
+  def commit(self, action):
+    movie = self.format()
+    write_outbox([(f'movie.{action}', movie)])
     db.session.commit()
+    versions.bump('movies')
+    notify_movie_listeners(action, movie)
+
+  '''
+  Takes `copies` copies of the movie inside the current transaction, a movie whose inventory
+  isn't tracked keeps `available` NULL. It is a single conditional UPDATE, so concurrent
+  rentals can't oversell and the row is only locked until the rent commits. Raises SoldOut
+  when not enough copies are left. Returns the movie formatted as updated, Postgres returns
+  it from the UPDATE, other databases read it back in the same transaction.
+  '''
+  @classmethod
+  def reserve(cls, movie_id, copies=1):
+    table = cls.__table__
+    columns = [table.c.id, table.c.movie_name, table.c.price, table.c.available]
+    update = table.update() \
+      .where(table.c.id == movie_id) \
+      .where(or_(table.c.available.is_(None), table.c.available >= copies)) \
+      .values(available=table.c.available - copies)
+    if db.engine.dialect.name == 'postgresql':
+      reserved = db.session.execute(update.returning(*columns)).first()
+    elif db.session.execute(update).rowcount == 1:
+      reserved = db.session.execute(select(columns).where(table.c.id == movie_id)).first()
+    else:
+      reserved = None
+    if reserved is None:
+      raise SoldOut(movie_id)
+    return dict(reserved)
+
+  '''
+  Inserts already validated `(index, {'movie_name', 'price'})` rows with one executemany per
+  batch, all inside a single transaction. With `upsert` rows whose movie_name exists update
+  its price instead, otherwise they are reported back as `(index, message)` errors.
+  Returns `(inserted, updated, errors)`.
+  '''
+  @classmethod
+  def bulk_insert(cls, rows, upsert=False, batch_size=BULK_BATCH_SIZE):
+    table = cls.__table__
+    inserted, updated, errors = 0, 0, []
+    try:
+      for batch in batches(rows, batch_size):
+        names = [row['movie_name'] for _, row in batch]
+        existing = {name for (name,) in db.session.execute(
+          select([table.c.movie_name]).where(table.c.movie_name.in_(names)))}
+        new_rows = [row for _, row in batch if row['movie_name'] not in existing]
+        old_rows = [(i, row) for i, row in batch if row['movie_name'] in existing]
+
+        if upsert and db.engine.dialect.name == 'postgresql':
+          # Let the unique constraint on movie_name resolve conflicts, this also covers concurrent imports.
+          stmt = pg_insert(table)
+          stmt = stmt.on_conflict_do_update(index_elements=[table.c.movie_name], set_={'price': stmt.excluded.price})
+          db.session.execute(stmt, [row for _, row in batch])
+        else:
+          if new_rows:
+            db.session.execute(table.insert(), new_rows)
+          if old_rows and upsert:
+            db.session.execute(
+              table.update().where(table.c.movie_name == bindparam('b_movie_name')).values(price=bindparam('b_price')),
+              [{'b_movie_name': row['movie_name'], 'b_price': row['price']} for _, row in old_rows])
+
+        inserted += len(new_rows)
+        if upsert:
+          updated += len(old_rows)
+        else:
+          errors.extend((i, 'movie_name already exists') for i, _ in old_rows)
+      write_outbox([('movie.bulk', None)])
+      db.session.commit()
+    except:
+      db.session.rollback()
+      raise
+
+    versions.bump('movies')
+    notify_movie_listeners('bulk', None)
+    return inserted, updated, errors
 
   def format(self):
     return {
       'id': self.id,
       'movie_name': self.movie_name,
       'price': self.price,
+      'available': self.available
     }
 
+class SoldOut(Exception):
+  def __init__(self, movie_id):
+    super().__init__(f'movie {movie_id} has no copies left')
+    self.movie_id = movie_id
+
 # Rents table with self methods and has relationships with movies.
 class Rents(db.Model):
   __tablename__ = 'rents'
+  # For `from` / `to` ranges over all rents or the rents of one movie.
+  __table_args__ = (
+    Index('ix_rents_movie_id_rented_at', 'movie_id', 'rented_at'),
+    Index('ix_rents_rented_at', 'rented_at'),
+  )
   id = db.Column(db.Integer, primary_key=True)
   movie_id = db.Column(db.Integer, db.ForeignKey('movies.id', ondelete='CASCADE'))
   charges = db.Column(Integer)
+  # UTC.
+  rented_at = db.Column(DateTime, nullable=False, default=datetime.utcnow)
   movie = relationship("Movies", cascade="all,delete", backref="movie")
 
   def __init__(self, movie_id, charges):
     self.movie_id = movie_id
     self.charges = charges
 
+  '''
+  Returns the new rent formatted like `format`, built before the commit expires the instance.
+  A copy of the movie is taken in the same transaction, SoldOut is raised when none is left.
+  '''
   def insert(self):
-    db.session.add(self)
-    db.session.commit()
+    return Rents.insert_many([self])[0]
 
-  def format(self):
+  '''
+  Inserts several rents in one transaction, either all of them are stored or none.
+  Every rent takes a copy of its movie, SoldOut is raised when one runs out.
+  Returns them formatted like `format`, with their movie as it is after this transaction.
+  '''
+  @classmethod
+  def insert_many(cls, rents):
+    copies = Counter(r.movie_id for r in rents)
+    try:
+      # Sorted so concurrent checkouts lock rows in the same order.
+      movies = {movie_id: Movies.reserve(movie_id, count) for movie_id, count in sorted(copies.items())}
+      db.session.add_all(rents)
+      db.session.flush()
+      committed = [r.format_row() for r in rents]
+      RentalStats.record(rents)
+      write_outbox([('rent.insert', rent) for rent in committed])
+      db.session.commit()
+    except:
+      db.session.rollback()
+      raise
+
+    versions.bump('rents')
+    if any(movie['available'] is not None for movie in movies.values()):
+      versions.bump('inventory')
+    notify_rent_listeners(committed)
+    return [dict(rent, movie=movies[rent['movie_id']]) for rent in committed]
+
+  '''
+  Moves rents from before `before` into monthly RentRollup rows, `batch_size` rents per
+  transaction so the rents table is never locked for long. A batch another run archived
+  first is rolled back and read again, so concurrent runs don't count a rent twice.
+  Returns the number of rents archived.
+  '''
+  @classmethod
+  def archive(cls, before, batch_size=BULK_BATCH_SIZE):
+    table = cls.__table__
+    archived = 0
+    while True:
+      try:
+        rows = db.session.execute(select([table.c.id, table.c.movie_id, table.c.charges, table.c.rented_at])
+          .where(table.c.rented_at < before)
+          .order_by(table.c.id)
+          .limit(batch_size)).fetchall()
+        if not rows:
+          break
+        deleted = db.session.execute(table.delete().where(table.c.id.in_([row.id for row in rows])))
+        if deleted.rowcount != len(rows):
+          db.session.rollback()
+          continue
+
+        totals = {}
+        for row in rows:
+          if row.movie_id is None:
+            continue
+          key = (row.movie_id, date(row.rented_at.year, row.rented_at.month, 1))
+          count, charges = totals.get(key, (0, 0))
+          totals[key] = (count + 1, charges + (row.charges or 0))
+        add_totals(RentRollup.__table__, ['movie_id', 'month'], totals)
+        db.session.commit()
+      except:
+        db.session.rollback()
+        raise
+      archived += len(rows)
+
+    if archived:
+      versions.bump('rents')
+    return archived
+
+  # The rent without its movie, as sent to rent listeners and in `rent.insert` events.
+  def format_row(self):
     return {
       'id': self.id,
       'movie_id': self.movie_id,
       'charges': self.charges,
-      'movie': self.movie.format()
-    }
\ No newline at end of file
+      'rented_at': self.rented_at.isoformat()
+    }
+
+  def format(self):
+    return dict(self.format_row(), movie=self.movie.format())
+
+'''
+Adds `{key: (count, charges)}` to the `rent_count` and `total_charges` of the rows of
+`table` whose `key_columns` equal `key`, creating missing rows, inside the current transaction.
+'''
+def add_totals(table, key_columns, totals):
+  # Sorted so concurrent checkouts lock rows in the same order.
+  for key, (count, charges) in sorted(totals.items()):
+    values = dict(zip(key_columns, key))
+    if db.engine.dialect.name == 'postgresql':
+      stmt = pg_insert(table).values(rent_count=count, total_charges=charges, **values)
+      db.session.execute(stmt.on_conflict_do_update(index_elements=[table.c[c] for c in key_columns], set_={
+        'rent_count': table.c.rent_count + stmt.excluded.rent_count,
+        'total_charges': table.c.total_charges + stmt.excluded.total_charges
+      }))
+      continue
+
+    match = and_(*[table.c[column] == value for column, value in values.items()])
+    updated = db.session.execute(table.update().where(match).values(
+      rent_count=table.c.rent_count + count,
+      total_charges=table.c.total_charges + charges))
+    if updated.rowcount == 0:
+      db.session.execute(table.insert().values(rent_count=count, total_charges=charges, **values))
+
+'''
+Rent count and total charges per movie, updated in the same transaction as every rent so
+analytics never have to scan the rents table. `rebuild()` recomputes it from scratch.
+'''
+class RentalStats(db.Model):
+  __tablename__ = 'rental_stats'
+  movie_id = db.Column(db.Integer, db.ForeignKey('movies.id', ondelete='CASCADE'), primary_key=True)
+  rent_count = db.Column(db.Integer, nullable=False, default=0)
+  total_charges = db.Column(BigInteger, nullable=False, default=0)
+
+  # Adds rents to the totals of their movies, inside the current transaction.
+  @classmethod
+  def record(cls, rents):
+    totals = {}
+    for rent in rents:
+      count, charges = totals.get((rent.movie_id,), (0, 0))
+      totals[(rent.movie_id,)] = (count + 1, charges + (rent.charges or 0))
+    add_totals(cls.__table__, ['movie_id'], totals)
+
+  # Recomputes the totals from the rents table and the archived RentRollup rows.
+  @classmethod
+  def rebuild(cls):
+    table = cls.__table__
+    rents = Rents.__table__
+    rollups = RentRollup.__table__
+    live = select([rents.c.movie_id, func.count().label('rent_count'), func.coalesce(func.sum(rents.c.charges), 0).label('total_charges')]) \
+      .where(rents.c.movie_id.isnot(None)) \
+      .group_by(rents.c.movie_id)
+    archived = select([rollups.c.movie_id, rollups.c.rent_count, rollups.c.total_charges])
+    both = union_all(live, archived).alias('totals')
+    try:
+      db.session.execute(table.delete())
+      db.session.execute(table.insert().from_select(
+        ['movie_id', 'rent_count', 'total_charges'],
+        select([both.c.movie_id, func.sum(both.c.rent_count), func.sum(both.c.total_charges)])
+          .group_by(both.c.movie_id)))
+      db.session.commit()
+    except:
+      db.session.rollback()
+      raise
+    versions.bump('rents')
+
+  def format(self):
+    return {
+      'movie_id': self.movie_id,
+      'rent_count': self.rent_count,
+      'total_charges': self.total_charges
+    }
+
+'''
+Rents archived by `Rents.archive`, totals per movie and calendar month (UTC) of `rented_at`.
+'''
+class RentRollup(db.Model):
+  __tablename__ = 'rent_rollups'
+  movie_id = db.Column(db.Integer, db.ForeignKey('movies.id', ondelete='CASCADE'), primary_key=True)
+  # First day of the month.
+  month = db.Column(Date, primary_key=True)
+  rent_count = db.Column(db.Integer, nullable=False, default=0)
+  total_charges = db.Column(BigInteger, nullable=False, default=0)
+
+  def format(self):
+    return {
+      'movie_id': self.movie_id,
+      'month': self.month.isoformat()[:7],
+      'rent_count': self.rent_count,
+      'total_charges': self.total_charges
+    }
+
+'''
+Responses of POST requests sent with an `Idempotency-Key` header, see idempotency.py.
+A row without `status_code` belongs to a request still being processed.
+'''
+class IdempotencyKey(db.Model):
+  __tablename__ = 'idempotency_keys'
+  owner = db.Column(String(255), primary_key=True)
+  key = db.Column(String(255), primary_key=True)
+  fingerprint = db.Column(String(64), nullable=False)
+  status_code = db.Column(Integer)
+  body = db.Column(Text)
+  mimetype = db.Column(String(100))
+  created_at = db.Column(DateTime, nullable=False)
+  expires_at = db.Column(DateTime, nullable=False, index=True)
+
+  # Deletes expired keys, returns how many were removed.
+  @classmethod
+  def sweep(cls, now):
+    try:
+      deleted = cls.query.filter(cls.expires_at < now).delete(synchronize_session=False)
+      db.session.commit()
+    except:
+      db.session.rollback()
+      raise
+    return deleted
+
+'''
+Change events written by every worker when the event feed uses the database, see events.py.
+'''
+class Event(db.Model):
+  __tablename__ = 'events'
+  id = db.Column(BigInteger().with_variant(Integer, 'sqlite'), primary_key=True)
+  type = db.Column(String(32), nullable=False)
+  data = db.Column(Text, nullable=False)
+  created_at = db.Column(DateTime, nullable=False, index=True)
+
+  # Deletes events created before `cutoff`, returns how many were removed.
+  @classmethod
+  def prune(cls, cutoff):
+    try:
+      deleted = cls.query.filter(cls.created_at < cutoff).delete(synchronize_session=False)
+      db.session.commit()
+    except:
+      db.session.rollback()
+      raise
+    return deleted
@@ -0,0 +1,62 @@
+import base64
+import json
+from sqlalchemy import and_, or_, false
+
+'''
+Helpers for keyset (cursor based) pagination.
+A cursor is an opaque token holding the sort key and the ordering values of the last row
+of a page, the next page starts right after that row. Values may be null.
+'''
+
+class InvalidCursor(ValueError):
+    pass
+
+def encode_cursor(sort, values):
+    raw = json.dumps([sort] + list(values), separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii').rstrip('=')
+
+'''
+Returns the values of a cursor made for `sort`, one per column of `columns`. Each has to be
+None or of the column's Python type, a client could have edited the cursor.
+'''
+def decode_cursor(cursor, sort, columns):
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        data = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+    except (ValueError, TypeError):
+        raise InvalidCursor(cursor)
+
+    if not isinstance(data, list) or len(data) != len(columns) + 1 or data[0] != sort:
+        raise InvalidCursor(cursor)
+    values = data[1:]
+    for column, value in zip(columns, values):
+        if value is not None and (isinstance(value, bool) or not isinstance(value, column.type.python_type)):
+            raise InvalidCursor(cursor)
+    return values
+
+'''
+Expands (a, b) > (x, y) into `a > x OR (a = x AND b > y)` so it works on every database.
+NULLs sort after every value, the way `order_by` pages them, so a cursor value can be None.
+'''
+def keyset_filter(columns, values, descending=False):
+    clauses = []
+    for i, column in enumerate(columns):
+        equal = [c.is_(None) if v is None else c == v for c, v in zip(columns[:i], values[:i])]
+        clauses.append(and_(*equal, before(column, values[i]) if descending else after(column, values[i])))
+    return or_(*clauses)
+
+def after(column, value):
+    if value is None:
+        return false()
+    return or_(column > value, column.is_(None))
+
+def before(column, value):
+    if value is None:
+        return column.isnot(None)
+    return column < value
+
+# The ORDER BY of `columns`, NULLs last ascending and first descending on every database.
+def keyset_order(columns, descending=False):
+    if descending:
+        return [c.desc().nullsfirst() for c in columns]
+    return [c.asc().nullslast() for c in columns]
@@ -0,0 +1,146 @@
+import itertools
+import logging
+import os
+import threading
+import time
+from functools import wraps
+from flask import g, request
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.exc import OperationalError
+
+'''
+Read replicas for the read-only routes. Routes decorated with `use_replica` read from one
+of DATABASE_REPLICA_URLS, picked round-robin among the healthy ones, while flushes and
+every other route use the primary. A replica is checked at most every
+REPLICA_HEALTH_INTERVAL seconds, one that fails or (on Postgres) lags more than
+REPLICA_MAX_LAG_SECONDS is skipped until its next check, and when none is usable reads
+fall back to the primary. The request that finds a check due runs it without holding the
+lock, the others keep using the last result meanwhile.
+
+After a successful write a client gets a cookie that keeps its reads on the primary for
+REPLICA_READ_YOUR_WRITES_SECONDS, so it always sees its own writes.
+'''
+
+DATABASE_REPLICA_URLS = [url.strip() for url in os.environ.get('DATABASE_REPLICA_URLS', '').split(',') if url.strip()]
+REPLICA_HEALTH_INTERVAL = float(os.environ.get('REPLICA_HEALTH_INTERVAL', 5))
+REPLICA_MAX_LAG_SECONDS = float(os.environ.get('REPLICA_MAX_LAG_SECONDS', 5))
+REPLICA_READ_YOUR_WRITES_SECONDS = int(os.environ.get('REPLICA_READ_YOUR_WRITES_SECONDS', 5))
+READ_YOUR_WRITES_COOKIE = 'read_primary_until'
+
+logger = logging.getLogger(__name__)
+
+# Replay lag of a Postgres standby, 0 when it has replayed everything it received.
+POSTGRES_LAG_QUERY = text(
+    'SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 '
+    'ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0) END')
+
+class Replica:
+    def __init__(self, url, engine):
+        self.url = url
+        self.engine = engine
+        self.healthy = True
+        self.checked_at = None
+        self.lag = None
+        self.checking = False
+
+class ReplicaSet:
+    def __init__(self, urls, engine_options=lambda url: {}, health_interval=REPLICA_HEALTH_INTERVAL,
+                 max_lag=REPLICA_MAX_LAG_SECONDS):
+        self.health_interval = health_interval
+        self.max_lag = max_lag
+        self.replicas = []
+        for url in urls:
+            replica = Replica(url, create_engine(url, **engine_options(url)))
+            event.listen(replica.engine, 'handle_error', self._on_error(replica))
+            self.replicas.append(replica)
+        self.stats = {'replica_reads': 0, 'primary_fallbacks': 0, 'failures': 0}
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+
+    def __bool__(self):
+        return bool(self.replicas)
+
+    def _on_error(self, replica):
+        def handle_error(context):
+            if context.is_disconnect or isinstance(context.sqlalchemy_exception, OperationalError):
+                self.mark_failed(replica)
+        return handle_error
+
+    def mark_failed(self, replica):
+        replica.healthy = False
+        replica.checked_at = time.monotonic()
+        self.stats['failures'] += 1
+        logger.warning('Replica %s marked unhealthy', replica.engine.url)
+
+    # `(healthy, lag)` of the replica, read from the replica itself.
+    def probe(self, replica):
+        try:
+            with replica.engine.connect() as conn:
+                if replica.engine.dialect.name == 'postgresql':
+                    lag = float(conn.execute(POSTGRES_LAG_QUERY).scalar() or 0)
+                else:
+                    conn.execute(text('SELECT 1'))
+                    lag = 0.0
+            return lag <= self.max_lag, lag
+        except Exception:
+            logger.warning('Replica %s failed its health check', replica.engine.url, exc_info=True)
+            return False, replica.lag
+
+    def check(self, replica):
+        healthy, lag = self.probe(replica)
+        with self._lock:
+            replica.healthy, replica.lag = healthy, lag
+            replica.checked_at = time.monotonic()
+            replica.checking = False
+
+    def _due(self, replica):
+        return replica.checked_at is None or time.monotonic() - replica.checked_at > self.health_interval
+
+    def _usable(self, replica):
+        if self._due(replica) and not replica.checking:
+            with self._lock:
+                claimed = self._due(replica) and not replica.checking
+                replica.checking = replica.checking or claimed
+            if claimed:
+                self.check(replica)
+        return replica.healthy
+
+    # Next healthy replica engine in round-robin order, None when the primary has to be used.
+    def choose(self):
+        for _ in range(len(self.replicas)):
+            replica = self.replicas[next(self._counter) % len(self.replicas)]
+            if self._usable(replica):
+                self.stats['replica_reads'] += 1
+                return replica.engine
+        if self.replicas:
+            self.stats['primary_fallbacks'] += 1
+        return None
+
+    def status(self):
+        return [{'url': repr(r.engine.url), 'healthy': r.healthy, 'lag_seconds': r.lag} for r in self.replicas]
+
+def reads_from_replica():
+    return g.get('use_replica', False)
+
+'''
+Lets the decorated GET route read from a replica, unless the client wrote recently.
+'''
+def use_replica(f):
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        read_primary_until = request.cookies.get(READ_YOUR_WRITES_COOKIE, type=float)
+        g.use_replica = read_primary_until is None or read_primary_until < time.time()
+        return f(*args, **kwargs)
+
+    return wrapper
+
+def init_replicas(app, replicas):
+    if not replicas:
+        return
+
+    @app.after_request
+    def read_your_writes(response):
+        if request.method not in ('GET', 'HEAD', 'OPTIONS') and response.status_code < 400:
+            response.set_cookie(READ_YOUR_WRITES_COOKIE, str(time.time() + REPLICA_READ_YOUR_WRITES_SECONDS),
+                                max_age=REPLICA_READ_YOUR_WRITES_SECONDS, httponly=True)
+        return response
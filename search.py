@@ -0,0 +1,149 @@
+import os
+import threading
+from collections import defaultdict
+from sqlalchemy import func, case, literal
+from cache import versions
+from models import db, Movies, movie_listeners
+
+'''
+Movie title search with prefix and typo tolerant matching.
+On Postgres it runs on the pg_trgm GIN index added by migration 5d2e8a7c4b13. Other
+databases use an in-process trigram index kept current by the movie write hooks, and
+rebuilt when another worker changes the 'search' version. When the version store doesn't see
+every write each search builds the index from the database instead.
+
+Both rank the same way: titles starting with the query first, then by trigram similarity
+(shared trigrams over all trigrams, like pg_trgm), then by id.
+'''
+
+SEARCH_BACKEND = os.environ.get('SEARCH_BACKEND', 'auto')
+SEARCH_SIMILARITY_THRESHOLD = float(os.environ.get('SEARCH_SIMILARITY_THRESHOLD', 0.3))
+# Default of pg_trgm.similarity_threshold, the threshold of the `%` operator.
+PG_TRGM_THRESHOLD = 0.3
+
+# Same padding as pg_trgm: two spaces before and one after every word.
+def trigrams(text):
+    grams = set()
+    for word in text.lower().split():
+        padded = f'  {word} '
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+class TrigramIndex:
+    def __init__(self, store=versions):
+        self.versions = store
+        self.stats = {'loads': 0, 'stale_reloads': 0, 'patches': 0, 'uncached': 0}
+        self._movies = None
+        self._grams = None
+        self._version = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _add(movies, grams_index, movie_id, name, price):
+        grams = trigrams(name or '')
+        movies[movie_id] = (name, price, (name or '').lower(), grams)
+        for gram in grams:
+            grams_index[gram].add(movie_id)
+
+    def _remove(self, movie_id):
+        movie = self._movies.pop(movie_id, None)
+        if movie is None:
+            return
+        for gram in movie[3]:
+            self._grams[gram].discard(movie_id)
+
+    def _rows(self):
+        return db.session.query(Movies.id, Movies.movie_name, Movies.price)
+
+    # `(movies, grams)` of every movie, freshly read.
+    def _build(self):
+        movies, grams = {}, defaultdict(set)
+        for movie_id, name, price in self._rows():
+            self._add(movies, grams, movie_id, name, price)
+        return movies, grams
+
+    def _load(self):
+        version = self.versions.get('search')
+        self._movies, self._grams = self._build()
+        self._version = version
+        self.stats['loads'] += 1
+
+    def _ensure_current(self):
+        version = self.versions.get('search')
+        if self._movies is None or self._version != version:
+            with self._lock:
+                if self._movies is not None and self._version != version:
+                    self.stats['stale_reloads'] += 1
+                    self._load()
+                elif self._movies is None:
+                    self._load()
+
+    def search(self, q, limit, offset):
+        if self.versions.sees_all_writes:
+            self._ensure_current()
+            movies, grams_index = self._movies, self._grams
+        else:
+            self.stats['uncached'] += 1
+            movies, grams_index = self._build()
+        query_grams = trigrams(q)
+        prefix = q.lower()
+
+        shared = defaultdict(int)
+        for gram in query_grams:
+            for movie_id in grams_index.get(gram, ()):
+                shared[movie_id] += 1
+
+        results = []
+        for movie_id, count in shared.items():
+            name, price, lowered, grams = movies[movie_id]
+            score = count / (len(query_grams) + len(grams) - count)
+            starts_with = lowered.startswith(prefix)
+            if starts_with or score >= SEARCH_SIMILARITY_THRESHOLD:
+                results.append((not starts_with, -score, movie_id, name, price))
+
+        results.sort()
+        return [(movie_id, name, price, -score) for _, score, movie_id, name, price in results[offset:offset + limit]]
+
+    def on_movie_change(self, action, movie):
+        version = self.versions.bump('search')
+        with self._lock:
+            # Only patch when no other process wrote in between, otherwise let the next search reload.
+            if self._movies is None or action == 'bulk' or self._version != version - 1:
+                return
+            if action in ('update', 'delete'):
+                self._remove(movie['id'])
+            if action in ('insert', 'update'):
+                self._add(self._movies, self._grams, movie['id'], movie['movie_name'], movie['price'])
+            self._version = version
+            self.stats['patches'] += 1
+
+trigram_index = TrigramIndex()
+movie_listeners.append(trigram_index.on_movie_change)
+
+def escape_like(text):
+    return text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+def search_postgres(q, limit, offset):
+    starts_with = Movies.movie_name.ilike(escape_like(q) + '%', escape='\\')
+    score = func.similarity(Movies.movie_name, q)
+    similar = score >= SEARCH_SIMILARITY_THRESHOLD
+    # `%` is what can use the trigram index, but it matches at pg_trgm's own threshold, so it
+    # only narrows the search when SEARCH_SIMILARITY_THRESHOLD isn't below that.
+    if SEARCH_SIMILARITY_THRESHOLD >= PG_TRGM_THRESHOLD:
+        similar = Movies.movie_name.op('%')(q) & similar
+    rows = db.session.query(Movies.id, Movies.movie_name, Movies.price, score) \
+        .filter(starts_with | similar) \
+        .order_by(case([(starts_with, literal(0))], else_=literal(1)), score.desc(), Movies.id) \
+        .limit(limit).offset(offset)
+    return [(movie_id, name, price, float(s)) for movie_id, name, price, s in rows]
+
+'''
+Returns one page of `(id, movie_name, price, score)` matches for `q`, best first.
+'''
+def search_movies(q, limit, offset):
+    backend = SEARCH_BACKEND
+    if backend == 'auto':
+        backend = 'postgres' if db.engine.dialect.name == 'postgresql' else 'memory'
+    if backend == 'postgres':
+        return search_postgres(q, limit, offset)
+    return trigram_index.search(q, limit, offset)
@@ -1,10 +1,27 @@
 import os
 import unittest
 import json
+import tempfile
+import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
 
 from app import create_app
-from models import setup_db
+from models import setup_db, db, Movies, Rents, migration_heads
+import time
+from auth import JWKSCache, TokenCache
+from cache import FileVersionStore, MemoryVersionStore
+from catalog import PriceCatalog
+from replicas import ReplicaSet
+from writebehind import WriteBehindQueue, QueueFull, RentPending
+from limits import ConcurrencyLimiter, Limits
+from serializers import RowEncoder, load_encoder
+from pagination import encode_cursor, decode_cursor, InvalidCursor
+from metrics import Registry
+from events import EventBroadcaster
+from search import TrigramIndex
 unittest.TestLoader.sortTestMethodsUsing = None
 
 class RentalAPITestCases(unittest.TestCase):
@@ -75,6 +92,31 @@ class RentalAPITestCases(unittest.TestCase):
         self.assertEqual(data["movies"][0]["id"], 1)
         self.assertEqual(data["movies"][0]["movie_name"], 'Avengers')
 
+    # Test that a repeated request with the current ETag is answered with 304.
+    def test_e_get_movies_not_modified(self):
+        etag = self.client().get('/movies').headers['ETag']
+        result = self.client().get('/movies', headers={'If-None-Match': etag})
+
+        self.assertEqual(result.status_code, 304)
+        self.assertEqual(result.data, b'')
+
+    # Test that only the requested fields are returned and unknown ones are rejected.
+    def test_e_get_movies_fields(self):
+        result = self.client().get('/movies?fields=id,price')
+        data = json.loads(result.data)
+
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(sorted(data["movies"][0]), ['id', 'price'])
+        self.assertEqual(self.client().get('/movies?fields=id,secret').status_code, 400)
+
+    # Test that an unknown sort option is rejected.
+    def test_e_get_movies_bad_sort(self):
+        result = self.client().get('/movies?sort=rating')
+        data = json.loads(result.data)
+
+        self.assertEqual(result.status_code, 400)
+        self.assertEqual(data["message"], "bad request")
+
     # Test to rent a movie by sending a user_token, user_token has permission to 'rent:movie`.
     def test_f_rent_movie(self):
         result = self.client().post('/rent-movie', headers={'Authorization': f'Bearer {os.environ["user_token"]}'} ,json={'movie_id': '1', 'days': 4})
@@ -85,6 +127,26 @@ class RentalAPITestCases(unittest.TestCase):
         self.assertEqual(data["rented_movie"]["id"], data["rented_movie"]["movie"]["id"])
         self.assertEqual(data["rented_movie"]["charges"], 800)
         self.assertEqual(data["rented_movie"]["movie_id"], 1)
+        self.assertEqual(sorted(data["rented_movie"]), ['charges', 'id', 'movie', 'movie_id', 'rented_at'])
+        self.assertEqual(sorted(data["rented_movie"]["movie"]), ['available', 'id', 'movie_name', 'price'])
+
+    # Test to rent several movies in one request.
+    def test_g_rent_many_movies(self):
+        result = self.client().post('/rent-movies', headers={'Authorization': f'Bearer {os.environ["user_token"]}'}, json={'items': [{'movie_id': 1, 'days': 1}, {'movie_id': 1, 'days': 2}]})
+        data = json.loads(result.data)
+
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(len(data["rented_movies"]), 2)
+        self.assertEqual(data["rented_movies"][1]["charges"], 400)
+        self.assertEqual(data["total_charges"], 600)
+
+    # Test that renting several movies fails as a whole when one of them doesn't exist.
+    def test_g_rent_many_movies_error(self):
+        result = self.client().post('/rent-movies', headers={'Authorization': f'Bearer {os.environ["user_token"]}'}, json={'items': [{'movie_id': 1, 'days': 1}, {'movie_id': 1000, 'days': 2}]})
+        data = json.loads(result.data)
+
+        self.assertEqual(result.status_code, 404)
+        self.assertFalse(data["success"])
 
     # Test to rent a movie by sending no token so it should fail.
     def test_g_rent_movie_error(self):
@@ -105,6 +167,72 @@ class RentalAPITestCases(unittest.TestCase):
         self.assertEqual(data["movies"][0]["id"], 1)
         self.assertEqual(data["movies"][0]["charges"], 800)
 
+    # Test that rented movies and their movies are loaded with a single query.
+    def test_h_get_rented_movies_query_count(self):
+        statements = []
+
+        def count_statement(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        with self.app.app_context():
+            engine = db.engine
+        event.listen(engine, 'before_cursor_execute', count_statement)
+        try:
+            result = self.client().get('/rented-movies')
+            data = json.loads(result.data)
+        finally:
+            event.remove(engine, 'before_cursor_execute', count_statement)
+
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(data["movies"][0]["movie"]["id"], 1)
+        self.assertEqual(len(statements), 1)
+
+    # Test that with embed=movie each movie is sent once instead of inside every rent.
+    def test_h_get_rented_movies_embedded(self):
+        result = self.client().post('/create-movie', headers={'Authorization': f'Bearer {os.environ["admin_token"]}'}, json={'movie_name': 'Embedded', 'price': 50})
+        movie_id = json.loads(result.data)["movie"]["id"]
+        for days in (1, 2):
+            self.client().post('/rent-movie', headers={'Authorization': f'Bearer {os.environ["user_token"]}'}, json={'movie_id': movie_id, 'days': days})
+
+        result = self.client().get(f'/rented-movies?movie_id={movie_id}&fields=id,charges&embed=movie&fields[movie]=movie_name')
+        data = json.loads(result.data)
+        self.client().delete(f'/movie/{movie_id}', headers={'Authorization': f'Bearer {os.environ["admin_token"]}'})
+
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(len(data["movies"]), 2)
+        self.assertEqual(sorted(data["movies"][0]), ['charges', 'id', 'movie_id'])
+        self.assertEqual(data["embedded"]["movies"], {str(movie_id): {'movie_name': 'Embedded'}})
+
+    # Test that rented movies are filtered by movie and by a rented_at range.
+    def test_h_get_rented_movies_range(self):
+        result = self.client().get('/rented-movies?movie_id=1&from=2000-01-01&fields=id,movie_id')
+        data = json.loads(result.data)
+
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(data["movies"][0], {'id': 1, 'movie_id': 1})
+        self.assertTrue(all(rent["movie_id"] == 1 for rent in data["movies"]))
+        self.assertEqual(json.loads(self.client().get('/rented-movies?to=2000-01-01').data)["movies"], [])
+        self.assertEqual(self.client().get('/rented-movies?from=yesterday').status_code, 400)
+
+    # Test that the rentals export resumes after the given id and answers in the negotiated format.
+    def test_h_export_rentals(self):
+        result = self.client().get('/export/rentals?after=1', headers={'Accept': 'text/csv'})
+        lines = result.data.decode().splitlines()
+
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(result.mimetype, 'text/csv')
+        self.assertEqual(lines[0], 'id,movie_id,charges,rented_at')
+        self.assertEqual([line.split(',')[0] for line in lines[1:]], ['2', '3'])
+
+    # Test that rental totals per movie include every rent made so far.
+    def test_h_rental_analytics(self):
+        result = self.client().get('/analytics/rentals?movie_id=1')
+        data = json.loads(result.data)
+
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(data["movie"]["rent_count"], 3)
+        self.assertEqual(data["movie"]["total_charges"], 1400)
+
     # Test for failing get rented movies by sending post instead of get so it should say 'method not allowed'.
     def test_i_get_rented_movies_error(self):
         # POST instead of GET
@@ -114,6 +242,19 @@ class RentalAPITestCases(unittest.TestCase):
         self.assertEqual(result.status_code, 405)
         self.assertEqual(data["message"], "method not allowed")
 
+    # Test that a retry with the same Idempotency-Key gets the stored response instead of a second rent.
+    def test_i_rent_movie_idempotent(self):
+        headers = {'Authorization': f'Bearer {os.environ["user_token"]}', 'Idempotency-Key': 'test-rent-1'}
+        first = self.client().post('/rent-movie', headers=headers, json={'movie_id': 1, 'days': 1})
+        retry = self.client().post('/rent-movie', headers=headers, json={'movie_id': 1, 'days': 1})
+        reused = self.client().post('/rent-movie', headers=headers, json={'movie_id': 1, 'days': 2})
+
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(retry.status_code, 200)
+        self.assertEqual(retry.headers.get('Idempotent-Replayed'), 'true')
+        self.assertEqual(json.loads(retry.data), json.loads(first.data))
+        self.assertEqual(reused.status_code, 422)
+
     # Test for deleting a movie by admin.
     def test_j_delete_movies(self):
         result = self.client().delete('/movie/1', headers={'Authorization': f'Bearer {os.environ["admin_token"]}'})
@@ -141,6 +282,82 @@ class RentalAPITestCases(unittest.TestCase):
         self.assertFalse(data["success"])
         self.assertEqual(data["message"], "resource not found")
 
+    # Test importing movies in bulk, invalid rows are reported and the rest are inserted.
+    def test_m_bulk_create_movies(self):
+        result = self.client().post('/movies/bulk', headers={'Authorization': f'Bearer {os.environ["admin_token"]}'}, json=[
+            {'movie_name': 'Inception', 'price': 100},
+            {'movie_name': 'Tenet', 'price': 150},
+            {'movie_name': 'Dunkirk'}
+        ])
+        data = json.loads(result.data)
+
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(data["inserted"], 2)
+        self.assertEqual(data["errors"][0]["row"], 2)
+
+    # Test that a user can't import movies.
+    def test_m_bulk_create_movies_error(self):
+        result = self.client().post('/movies/bulk', headers={'Authorization': f'Bearer {os.environ["user_token"]}'}, json=[])
+        data = json.loads(result.data)
+
+        self.assertEqual(result.status_code, 403)
+        self.assertEqual(data["code"], "unauthorized")
+
+    # Test that following next_cursor visits every movie once, movies without a price included.
+    def test_m_get_movies_pages(self):
+        admin = {'Authorization': f'Bearer {os.environ["admin_token"]}'}
+        result = self.client().post('/create-movie', headers=admin, json={'movie_name': 'Unpriced', 'price': None})
+        unpriced = json.loads(result.data)["movie"]["id"]
+
+        def walk(sort):
+            ids, cursor = [], ''
+            while cursor is not None:
+                data = json.loads(self.client().get(f'/movies?sort={sort}&limit=2&cursor={cursor}').data)
+                ids += [movie["id"] for movie in data["movies"]]
+                cursor = data["next_cursor"] or None
+            return ids
+
+        ascending, descending = walk('price'), walk('-price')
+        with self.app.app_context():
+            count = Movies.query.count()
+
+        self.assertEqual(len(set(ascending)), count)
+        self.assertEqual(len(ascending), count)
+        self.assertEqual(ascending[-1], unpriced)
+        self.assertEqual(descending, ascending[::-1])
+
+    # Stress test: parallel rents of a tracked movie never take more copies than there are.
+    def test_n_rent_movie_no_oversell(self):
+        admin = {'Authorization': f'Bearer {os.environ["admin_token"]}'}
+        result = self.client().post('/create-movie', headers=admin, json={'movie_name': 'Limited Edition', 'price': 100, 'available': 5})
+        movie_id = json.loads(result.data)["movie"]["id"]
+
+        def rent(_):
+            return self.client().post('/rent-movie', headers={'Authorization': f'Bearer {os.environ["user_token"]}'}, json={'movie_id': movie_id, 'days': 1}).status_code
+
+        with ThreadPoolExecutor(max_workers=10) as executor:
+            statuses = list(executor.map(rent, range(40)))
+
+        self.assertEqual(statuses.count(200), 5)
+        self.assertEqual(statuses.count(409), 35)
+        with self.app.app_context():
+            self.assertEqual(db.session.query(Movies.available).filter(Movies.id == movie_id).scalar(), 0)
+            self.assertEqual(Rents.query.filter(Rents.movie_id == movie_id).count(), 5)
+
+    # Test to update only the copies in stock of a movie, a body without any movie field is a bad request.
+    def test_n_update_movie_available(self):
+        admin = {'Authorization': f'Bearer {os.environ["admin_token"]}'}
+        result = self.client().post('/create-movie', headers=admin, json={'movie_name': 'Restocked', 'price': 100, 'available': 0})
+        movie_id = json.loads(result.data)["movie"]["id"]
+
+        result = self.client().patch(f'/movie/{movie_id}', headers=admin, json={'available': 1})
+        data = json.loads(result.data)
+
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(data["movie"]["available"], 1)
+        self.assertEqual(data["movie"]["price"], 100)
+        self.assertEqual(self.client().patch(f'/movie/{movie_id}', headers=admin, json={'days': 1}).status_code, 400)
+        self.assertEqual(self.client().patch(f'/movie/{movie_id}', headers=admin, json={}).status_code, 400)
 
 
     # Tests for RBAC (Role based access control)
@@ -173,6 +390,456 @@ class RentalAPITestCases(unittest.TestCase):
         self.assertEqual(result.status_code, 403)
         self.assertEqual(data["code"], "unauthorized")
 
+
+class JWKSCacheTestCases(unittest.TestCase):
+    """Tests for the in-process JWKS cache, served from a local file."""
+
+    def setUp(self):
+        self.jwks_file = tempfile.NamedTemporaryFile('w', suffix='.json', delete=False)
+        self.write_keys('key-1')
+        self.cache = JWKSCache(f'file://{self.jwks_file.name}', ttl=600, min_refetch_interval=600)
+
+    def tearDown(self):
+        os.unlink(self.jwks_file.name)
+
+    def write_keys(self, *kids):
+        with open(self.jwks_file.name, 'w') as f:
+            json.dump({'keys': [{'kty': 'RSA', 'kid': kid, 'use': 'sig', 'n': 'n', 'e': 'AQAB'} for kid in kids]}, f)
+
+    # Keys are fetched once and then served from memory.
+    def test_cache_hit(self):
+        self.assertEqual(self.cache.get_key('key-1')['kid'], 'key-1')
+        self.assertEqual(self.cache.get_key('key-1')['kid'], 'key-1')
+
+        self.assertEqual(self.cache.stats['refreshes'], 1)
+        self.assertEqual(self.cache.stats['hits'], 2)
+
+    # An unknown kid forces one refetch, further misses are rate limited.
+    def test_unknown_kid_refetch(self):
+        self.cache.get_key('key-1')
+        self.write_keys('key-1', 'key-2')
+
+        self.assertEqual(self.cache.get_key('key-2')['kid'], 'key-2')
+        self.assertIsNone(self.cache.get_key('key-3'))
+        self.assertEqual(self.cache.stats['forced_refreshes'], 1)
+        self.assertEqual(self.cache.stats['misses'], 2)
+
+class TokenCacheTestCases(unittest.TestCase):
+    """Tests for the verified token cache."""
+
+    # Entries are dropped once the token's exp claim has passed.
+    def test_expires_with_token(self):
+        cache = TokenCache(max_entries=10, max_age=600)
+        cache.put('fresh', {'exp': time.time() + 60})
+        cache.put('stale', {'exp': time.time() - 1})
+
+        self.assertIsNotNone(cache.get('fresh'))
+        self.assertIsNone(cache.get('stale'))
+        self.assertEqual(cache.stats['expirations'], 1)
+
+    # The least recently used entry is evicted when the cache is full.
+    def test_lru_eviction(self):
+        cache = TokenCache(max_entries=2, max_age=600)
+        cache.put('a', {})
+        cache.put('b', {})
+        cache.get('a')
+        cache.put('c', {})
+
+        self.assertIsNone(cache.get('b'))
+        self.assertIsNotNone(cache.get('a'))
+        self.assertEqual(cache.stats['evictions'], 1)
+
+class VersionStoreTestCases(unittest.TestCase):
+    """Tests for the shared catalog version stamps."""
+
+    # Two stores on the same file, like two gunicorn workers, see each other's bumps.
+    def test_file_store_is_shared(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'versions.json')
+            worker_a = FileVersionStore(path)
+            worker_b = FileVersionStore(path)
+
+            before = worker_b.get('movies')
+            worker_a.bump('movies')
+
+            self.assertEqual(worker_b.get('movies'), before + 1)
+
+class StaticCatalog(PriceCatalog):
+    """A price catalog reading from a dict instead of the database."""
+
+    def __init__(self, store, movies):
+        super().__init__(store)
+        self.movies = movies
+        self.queries = 0
+
+    def _rows(self, movie_ids=None):
+        self.queries += 1
+        return [(id, name, price) for id, (name, price) in self.movies.items()
+                if movie_ids is None or id in movie_ids]
+
+class PriceCatalogTestCases(unittest.TestCase):
+    """Tests for the in-process price catalog."""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'versions.json')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    # A write made by another worker forces a reload, the stale price is never returned.
+    def test_reloads_after_bump_elsewhere(self):
+        catalog = StaticCatalog(FileVersionStore(self.path), {1: ('Tenet', 10)})
+        self.assertEqual(catalog.get(1)['price'], 10)
+
+        catalog.movies[1] = ('Tenet', 1000)
+        FileVersionStore(self.path).bump('prices')
+
+        self.assertEqual(catalog.get(1)['price'], 1000)
+        self.assertEqual(catalog.stats['stale_reloads'], 1)
+
+    # A write made by this worker patches the catalog without reloading it.
+    def test_patches_local_write(self):
+        catalog = StaticCatalog(FileVersionStore(self.path), {1: ('Tenet', 10)})
+        catalog.get(1)
+
+        catalog.on_movie_change('update', {'id': 1, 'movie_name': 'Tenet', 'price': 20, 'available': None})
+        catalog.on_movie_change('insert', {'id': 2, 'movie_name': 'Dunkirk', 'price': 30, 'available': None})
+
+        self.assertEqual(catalog.get(1)['price'], 20)
+        self.assertEqual(catalog.get(2)['price'], 30)
+        self.assertEqual(catalog.queries, 1)
+        self.assertEqual(catalog.stats['patches'], 2)
+
+    # With a per-process version store and several processes every lookup reads the database.
+    def test_unshared_store_is_not_cached(self):
+        catalog = StaticCatalog(MemoryVersionStore(processes=2), {1: ('Tenet', 10)})
+        catalog.get(1)
+        catalog.movies[1] = ('Tenet', 1000)
+
+        self.assertEqual(catalog.get(1)['price'], 1000)
+        self.assertEqual(catalog.queries, 2)
+
+    # A single process sees all its writes in its own memory store.
+    def test_single_process_memory_store_is_cached(self):
+        catalog = StaticCatalog(MemoryVersionStore(processes=1), {1: ('Tenet', 10)})
+        catalog.get(1)
+        catalog.on_movie_change('update', {'id': 1, 'movie_name': 'Tenet', 'price': 20, 'available': None})
+
+        self.assertEqual(catalog.get(1)['price'], 20)
+        self.assertEqual(catalog.queries, 1)
+
+class StaticTrigramIndex(TrigramIndex):
+    """A trigram index reading from a dict instead of the database."""
+
+    def __init__(self, store, movies):
+        super().__init__(store)
+        self.movies = movies
+
+    def _rows(self):
+        return [(id, name, price) for id, (name, price) in self.movies.items()]
+
+class TrigramIndexTestCases(unittest.TestCase):
+    """Tests for the in-process search index."""
+
+    def setUp(self):
+        self.index = StaticTrigramIndex(MemoryVersionStore(), {
+            1: ('Winter Sleep', 10), 2: ('Interstellar', 20), 3: ('The Internship', 30),
+            4: ('Inter Nos', 40), 5: ('Dunkirk', 50)})
+
+    def ids(self, q):
+        return [movie_id for movie_id, _, _, _ in self.index.search(q, 10, 0)]
+
+    # Titles starting with the query come before ones that only share trigrams with it.
+    def test_prefix_matches_rank_first(self):
+        ids = self.ids('inter')
+
+        self.assertEqual(set(ids[:2]), {2, 4})
+        self.assertNotIn(5, ids)
+
+    def test_typo_matches_pass_threshold(self):
+        results = self.index.search('intersteller', 10, 0)
+
+        self.assertEqual(results[0][0], 2)
+        self.assertGreaterEqual(results[0][3], 0.3)
+        self.assertEqual(self.ids('dunkrik')[:1], [5])
+        self.assertEqual(self.ids('zzzz'), [])
+
+    # Writes of this worker patch the loaded index instead of reloading it.
+    def test_writes_patch_the_index(self):
+        self.ids('inter')
+
+        self.index.on_movie_change('insert', {'id': 6, 'movie_name': 'Tenet', 'price': 60})
+        self.assertEqual(self.ids('tenet'), [6])
+
+        self.index.on_movie_change('update', {'id': 6, 'movie_name': 'Oppenheimer', 'price': 60})
+        self.assertEqual(self.ids('tenet'), [])
+        self.assertEqual(self.ids('oppenhiemer'), [6])
+
+        self.index.on_movie_change('delete', {'id': 6})
+        self.assertEqual(self.ids('oppenheimer'), [])
+        self.assertEqual(self.index.stats['loads'], 1)
+        self.assertEqual(self.index.stats['patches'], 3)
+
+    # With a per-process version store and several processes every search reads the movies.
+    def test_unshared_store_is_not_cached(self):
+        index = StaticTrigramIndex(MemoryVersionStore(processes=2), {1: ('Tenet', 10)})
+        index.search('tenet', 10, 0)
+        index.movies[2] = ('Tenet II', 20)
+
+        self.assertEqual([row[0] for row in index.search('tenet', 10, 0)], [1, 2])
+        self.assertEqual(index.stats['uncached'], 2)
+        self.assertEqual(index.stats['loads'], 0)
+
+class ReplicaSetTestCases(unittest.TestCase):
+    """Tests for read replica selection, using two local SQLite databases."""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.urls = [f'sqlite:///{os.path.join(self.tmp.name, name)}' for name in ('replica1.db', 'replica2.db')]
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    # Healthy replicas are used in turn.
+    def test_round_robin(self):
+        replica_set = ReplicaSet(self.urls)
+        chosen = [str(replica_set.choose().url) for _ in range(4)]
+
+        self.assertEqual(chosen, [self.urls[0], self.urls[1], self.urls[0], self.urls[1]])
+
+    # A failing replica is skipped and without any usable replica reads go to the primary.
+    def test_fallback(self):
+        broken = f'sqlite:///{os.path.join(self.tmp.name, "missing", "replica.db")}'
+        replica_set = ReplicaSet([broken, self.urls[0]])
+
+        self.assertEqual(str(replica_set.choose().url), self.urls[0])
+        self.assertEqual(str(replica_set.choose().url), self.urls[0])
+
+        replica_set = ReplicaSet([broken])
+        self.assertIsNone(replica_set.choose())
+        self.assertEqual(replica_set.stats['primary_fallbacks'], 1)
+
+    # A slow health check of one replica doesn't hold up requests routed to the other.
+    def test_slow_check_does_not_block(self):
+        release = threading.Event()
+
+        class SlowReplicaSet(ReplicaSet):
+            def probe(self, replica):
+                if replica is self.replicas[0]:
+                    release.wait(5)
+                return super().probe(replica)
+
+        replica_set = SlowReplicaSet(self.urls)
+        slow = threading.Thread(target=replica_set.choose)
+        slow.start()
+        while not replica_set.replicas[0].checking:
+            time.sleep(0.001)
+
+        started = time.monotonic()
+        self.assertEqual(str(replica_set.choose().url), self.urls[1])
+        self.assertLess(time.monotonic() - started, 1)
+        release.set()
+        slow.join()
+
+class RecordingQueue(WriteBehindQueue):
+    """Write-behind queue that records batch sizes instead of writing to a database."""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.release = threading.Event()
+        self.batches = []
+
+    def _write(self, batch):
+        self.release.wait(5)
+        self.batches.append(len(batch))
+        for i, (_, _, future) in enumerate(batch):
+            future.set_result(i)
+
+class MetricsRegistryTestCases(unittest.TestCase):
+    """Tests for merging the metrics of several workers."""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def worker(self, requests, seconds, connections):
+        registry = Registry(self.tmp.name)
+        counter = registry.counter('requests_total', 'Requests.', ('route',))
+        histogram = registry.histogram('request_seconds', 'Latency.', buckets=(0.1, 1.0))
+        registry.add_collector(lambda: [('connections', 'Open connections.', (), {(): connections})])
+        counter.inc('/movies', amount=requests)
+        for value in seconds:
+            histogram.observe(value)
+        return registry
+
+    # Counters and histograms are summed, gauges of live workers get a pid label.
+    def test_render_merges_snapshots(self):
+        exited = subprocess.Popen(['true'])
+        exited.wait()
+        for pid, registry in ((os.getppid(), self.worker(2, [0.5], 3)), (exited.pid, self.worker(4, [0.05, 5.0], 9))):
+            with open(registry.snapshot_path(pid), 'w') as f:
+                json.dump(registry.snapshot(), f)
+
+        lines = self.worker(1, [0.05], 1).render().splitlines()
+
+        self.assertIn('requests_total{route="/movies"} 7', lines)
+        self.assertIn('request_seconds_bucket{le="0.1"} 2', lines)
+        self.assertIn('request_seconds_bucket{le="1.0"} 3', lines)
+        self.assertIn('request_seconds_bucket{le="+Inf"} 4', lines)
+        self.assertIn('request_seconds_count 4', lines)
+        self.assertIn(f'connections{{pid="{os.getpid()}"}} 1', lines)
+        self.assertIn(f'connections{{pid="{os.getppid()}"}} 3', lines)
+        self.assertFalse(any(f'pid="{exited.pid}"' in line for line in lines))
+
+class WriteBehindQueueTestCases(unittest.TestCase):
+    """Tests for batching and backpressure of the rent write-behind queue."""
+
+    # Rents queued within the batch interval are written together.
+    def test_batches_rows(self):
+        rent_queue = RecordingQueue(batch_size=3, interval=1)
+        rent_queue.release.set()
+        futures = [rent_queue.submit(1, 100) for _ in range(3)]
+
+        self.assertEqual([f.result(5) for f in futures], [0, 1, 2])
+        self.assertEqual(rent_queue.batches, [3])
+        rent_queue.drain()
+
+    # Once the queue is full further rents are rejected, queued ones are still written on drain.
+    def test_backpressure_and_drain(self):
+        rent_queue = RecordingQueue(batch_size=1, interval=0, max_pending=1, put_timeout=0.01)
+        futures = []
+        with self.assertRaises(QueueFull):
+            for _ in range(3):
+                futures.append(rent_queue.submit(1, 100))
+
+        self.assertEqual(rent_queue.stats['rejected'], 1)
+        rent_queue.release.set()
+        rent_queue.drain()
+        self.assertTrue(all(f.done() for f in futures))
+        with self.assertRaises(QueueFull):
+            rent_queue.submit(1, 100)
+
+    # A rent still queued when its request gives up is dropped instead of written later.
+    def test_timed_out_rent_is_dropped(self):
+        rent_queue = RecordingQueue(batch_size=1, interval=0)
+        first = rent_queue.submit(1, 100)
+        while rent_queue.pending():
+            time.sleep(0.001)
+
+        with self.assertRaises(QueueFull):
+            rent_queue.rent(2, 100, timeout=0.05)
+        rent_queue.release.set()
+        rent_queue.drain()
+
+        self.assertEqual(first.result(5), 0)
+        self.assertEqual(rent_queue.batches, [1])
+        self.assertEqual(rent_queue.stats['dropped'], 1)
+
+    # A rent the writer took but didn't commit in time, or whose batch failed, is reported as pending.
+    def test_unfinished_rent_is_pending(self):
+        rent_queue = RecordingQueue(batch_size=1, interval=0)
+        with self.assertRaises(RentPending):
+            rent_queue.rent(1, 100, timeout=0.05)
+        rent_queue.release.set()
+        rent_queue.drain()
+
+        rent_queue = RecordingQueue(batch_size=1, interval=0)
+        # Makes `_write` fail.
+        rent_queue.batches = None
+        rent_queue.release.set()
+        with self.assertRaises(RentPending):
+            rent_queue.rent(1, 100, timeout=5)
+        rent_queue.drain()
+
+class ConcurrencyLimiterTestCases(unittest.TestCase):
+    """Tests for the concurrency limits used to shed load."""
+
+    # Past the limit requests queue, past the queue they are shed right away.
+    def test_sheds_when_queue_full(self):
+        limiter = ConcurrencyLimiter(limit=1, queue=0, timeout=1)
+
+        self.assertTrue(limiter.acquire())
+        self.assertFalse(limiter.acquire())
+        limiter.release()
+        self.assertTrue(limiter.acquire())
+        self.assertEqual(limiter.stats['shed'], 1)
+
+    # Raising the limit at runtime lets a queued request in.
+    def test_configure_admits_queued(self):
+        limits = Limits(budgets={'read': {'limit': 1, 'queue': 1, 'timeout': 5}})
+        limiter = limits.limiter('get_all_movies', 'GET')
+        limiter.acquire()
+        admitted = []
+        waiter = threading.Thread(target=lambda: admitted.append(limiter.acquire()))
+        waiter.start()
+        while limiter.waiting == 0:
+            time.sleep(0.01)
+
+        limits.configure({'budgets': {'read': {'limit': 2}}})
+        waiter.join(1)
+        self.assertEqual(admitted, [True])
+        with self.assertRaises(ValueError):
+            limits.configure({'budgets': {'read': {'limit': -1}}})
+
+class RowEncoderTestCases(unittest.TestCase):
+    """Tests for encoding row tuples straight to JSON."""
+
+    # The standard library template path gives the same objects as encoding dicts.
+    def test_matches_dicts(self):
+        encoder = RowEncoder(['id', 'charges'], nested=('movie', ['movie_name', 'available']), encoder=load_encoder('json'))
+        rows = [(1, 200, 'Say "%s"', None), (2, 1.5, 'Amélie', True)]
+
+        self.assertEqual(json.loads(encoder.encode(rows)), encoder.dicts(rows))
+        self.assertEqual(encoder.encode([]), b'[]')
+        self.assertEqual([json.loads(line) for line in encoder.lines(rows).splitlines()], encoder.dicts(rows))
+
+class CursorTestCases(unittest.TestCase):
+    """Tests for decoding the keyset pagination cursors sent by clients."""
+
+    columns = [Movies.price, Movies.id]
+
+    def test_round_trip(self):
+        self.assertEqual(decode_cursor(encode_cursor('price', [None, 3]), 'price', self.columns), [None, 3])
+
+    # An edited cursor is rejected before its values reach the query.
+    def test_tampered_cursor_is_invalid(self):
+        for values in ([{'a': 1}, 3], [[1], 3], [True, 3], ['cheap', 3], [1], [1, 3, 5]):
+            with self.assertRaises(InvalidCursor):
+                decode_cursor(encode_cursor('price', values), 'price', self.columns)
+        with self.assertRaises(InvalidCursor):
+            decode_cursor(encode_cursor('-price', [1, 3]), 'price', self.columns)
+
+class EventBroadcasterTestCases(unittest.TestCase):
+    """Tests for the ring buffer behind the event stream."""
+
+    # Clients resume after their last id until it has been evicted.
+    def test_since(self):
+        broadcaster = EventBroadcaster(size=2, start=0)
+        for i in range(3):
+            broadcaster.publish('movie.update', str(i))
+
+        self.assertEqual(broadcaster.since(1), [(2, 'movie.update', '1'), (3, 'movie.update', '2')])
+        self.assertEqual(broadcaster.since(3), [])
+        self.assertIsNone(broadcaster.since(0))
+        self.assertIsNone(broadcaster.since(4))
+
+    def test_wait(self):
+        broadcaster = EventBroadcaster(start=0)
+        self.assertEqual(broadcaster.wait(0, 0.01), [])
+
+        threading.Timer(0.05, broadcaster.publish, ('rent.insert', '{}')).start()
+        self.assertEqual(broadcaster.wait(0, 5), [(1, 'rent.insert', '{}')])
+
+class MigrationTestCases(unittest.TestCase):
+    """Tests for reading the migration history without alembic."""
+
+    # Every migration builds on the previous one, so there is a single head.
+    def test_single_head(self):
+        self.assertEqual(len(migration_heads()), 1)
+
 # Make the tests conveniently executable
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
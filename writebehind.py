@@ -0,0 +1,186 @@
+import atexit
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+from models import db, Rents
+
+'''
+Group commit for rentals. With RENT_WRITE_BEHIND=1 `/rent-movie` hands its row to an
+in-process queue instead of committing it itself. A background writer takes up to
+RENT_BATCH_SIZE rows, waiting at most RENT_BATCH_INTERVAL_MS for more after the first, and
+stores them with `Rents.insert_many` in one transaction, so many requests share one commit.
+Each request waits on a future for its formatted rent, the response is only sent once the
+row is committed.
+
+At most RENT_QUEUE_MAX_PENDING rows wait in the queue, a request that can't get in within
+RENT_QUEUE_PUT_TIMEOUT seconds is rejected with 503. A rent still queued after
+RENT_RESULT_TIMEOUT seconds is dropped and rejected the same way, so a retry can't rent twice.
+One the writer already took gets another RENT_RESULT_TIMEOUT seconds to commit, if it still
+isn't done, or the writer failed on its batch, it may be stored and its request gets a 503
+that keeps its idempotency key pending. Rows still queued when the worker exits are written
+before it stops.
+'''
+
+RENT_WRITE_BEHIND = os.environ.get('RENT_WRITE_BEHIND', '0') == '1'
+RENT_BATCH_SIZE = int(os.environ.get('RENT_BATCH_SIZE', 100))
+RENT_BATCH_INTERVAL_MS = float(os.environ.get('RENT_BATCH_INTERVAL_MS', 5))
+RENT_QUEUE_MAX_PENDING = int(os.environ.get('RENT_QUEUE_MAX_PENDING', 1000))
+RENT_QUEUE_PUT_TIMEOUT = float(os.environ.get('RENT_QUEUE_PUT_TIMEOUT', 0.5))
+RENT_RESULT_TIMEOUT = float(os.environ.get('RENT_RESULT_TIMEOUT', 10))
+
+logger = logging.getLogger(__name__)
+
+class QueueFull(Exception):
+    pass
+
+# The rent was queued but whether it is stored isn't known yet.
+class RentPending(Exception):
+    pass
+
+class WriteBehindQueue:
+    def __init__(self, batch_size=RENT_BATCH_SIZE, interval=RENT_BATCH_INTERVAL_MS / 1000,
+                 max_pending=RENT_QUEUE_MAX_PENDING, put_timeout=RENT_QUEUE_PUT_TIMEOUT):
+        self.batch_size = batch_size
+        self.interval = interval
+        self.max_pending = max_pending
+        self.put_timeout = put_timeout
+        self.app = None
+        self.stats = {'rows': 0, 'batches': 0, 'largest_batch': 0, 'rejected': 0, 'dropped': 0, 'failed': 0}
+        self._queue = None
+        self._thread = None
+        self._pid = None
+        self._stopping = False
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.app = app
+
+    # The writer is started on first use and again in a forked worker, threads don't survive a fork.
+    def _ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                self._queue = queue.Queue(self.max_pending)
+                self._stopping = False
+                self._thread = threading.Thread(target=self._run, name='rent-writer', daemon=True)
+                self._thread.start()
+                self._pid = os.getpid()
+
+    '''
+    Queues a rent and returns a future resolving to the formatted rent once committed.
+    Raises QueueFull when the queue stays full for `put_timeout` seconds.
+    '''
+    def submit(self, movie_id, charges):
+        self._ensure_started()
+        if self._stopping:
+            raise QueueFull()
+        future = Future()
+        try:
+            self._queue.put((movie_id, charges, future), timeout=self.put_timeout)
+        except queue.Full:
+            self.stats['rejected'] += 1
+            raise QueueFull()
+        return future
+
+    '''
+    Queues a rent and waits up to `timeout` seconds for it to be committed. Raises QueueFull when it is
+    still queued by then (it is dropped), RentPending when the writer took it but didn't
+    commit it within another `timeout` seconds or failed on its batch.
+    '''
+    def rent(self, movie_id, charges, timeout=RENT_RESULT_TIMEOUT):
+        future = self.submit(movie_id, charges)
+        try:
+            return future.result(timeout)
+        except FutureTimeout:
+            if future.cancel():
+                self.stats['dropped'] += 1
+                raise QueueFull()
+        try:
+            return future.result(timeout)
+        except FutureTimeout:
+            raise RentPending()
+
+    def pending(self):
+        return self._queue.qsize() if self._queue is not None and self._pid == os.getpid() else 0
+
+    def _next_batch(self):
+        item = self._queue.get()
+        if item is None:
+            return None
+        batch = [item]
+        deadline = time.monotonic() + self.interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                # Stop after this batch, the sentinel goes back for the loop to see.
+                self._queue.put(None)
+                break
+            batch.append(item)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            # Rents whose request gave up are dropped, the others can't be cancelled anymore.
+            batch = [item for item in batch if item[2].set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            try:
+                self._write(batch)
+            except Exception:
+                logger.exception('Rent writer failed on a batch of %d', len(batch))
+                for _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(RentPending())
+
+    def _write(self, batch):
+        with self.app.app_context():
+            try:
+                try:
+                    rents = Rents.insert_many([Rents(movie_id=movie_id, charges=charges) for movie_id, charges, _ in batch])
+                except Exception:
+                    # One bad row (e.g. a sold out or deleted movie) must not fail the others.
+                    self.stats['failed'] += 1
+                    rents = []
+                    for movie_id, charges, future in batch:
+                        try:
+                            rents.append(Rents(movie_id=movie_id, charges=charges).insert())
+                        except Exception as e:
+                            rents.append(e)
+            finally:
+                db.session.remove()
+
+        self.stats['batches'] += 1
+        self.stats['rows'] += len(batch)
+        self.stats['largest_batch'] = max(self.stats['largest_batch'], len(batch))
+        for (_, _, future), rent in zip(batch, rents):
+            if isinstance(rent, Exception):
+                future.set_exception(rent)
+            else:
+                future.set_result(rent)
+
+    # Stops taking rents and waits for the writer to store the ones already queued.
+    def drain(self, timeout=RENT_RESULT_TIMEOUT):
+        if self._pid != os.getpid() or self._stopping:
+            return
+        self._stopping = True
+        self._queue.put(None)
+        self._thread.join(timeout)
+
+rent_queue = WriteBehindQueue()
+
+def init_write_behind(app):
+    if not RENT_WRITE_BEHIND:
+        return
+    rent_queue.init_app(app)
+    atexit.register(rent_queue.drain)